@@ -0,0 +1,70 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2015 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+# Times the cpu fact collectors of hwprobe on synthetic sysfs trees of
+# large machines.
+#
+# Run from the top of the source tree like:
+#
+#    python scripts/cpu_info_benchmark.py [cpus ...]
+#
+# which defaults to trees of 1024, 4096 and 8192 cpus, with 2 threads per
+# core and 32 cores per socket.
+
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path[0:0] = ['src', 'test']
+
+from cputree import write_cpu_tree
+from subscription_manager import hwprobe
+
+RUNS = 5
+
+
+def best_of(runs, func):
+    times = []
+    for i in range(runs):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def benchmark(cpus):
+    prefix = tempfile.mkdtemp(prefix='cpu-info-benchmark')
+    try:
+        write_cpu_tree(prefix, cpus, threads_per_core=2, cores_per_socket=32)
+
+        def cpu_info():
+            hw = hwprobe.Hardware(prefix=prefix, testing=True)
+            hw.arch = 'x86_64'
+            hw.get_cpu_info()
+
+        def ls_cpu_info():
+            hwprobe.Hardware(prefix=prefix, testing=True).get_ls_cpu_info()
+
+        print "%6s cpus: get_cpu_info %.4fs, get_ls_cpu_info %.4fs" % \
+            (cpus, best_of(RUNS, cpu_info), best_of(RUNS, ls_cpu_info))
+    finally:
+        shutil.rmtree(prefix)
+
+
+if __name__ == '__main__':
+    for cpus in [int(arg) for arg in sys.argv[1:]] or [1024, 4096, 8192]:
+        benchmark(cpus)
@@ -20,16 +20,20 @@ necessary.
 """
 
 import gettext
+import hashlib
 import logging
 import os
 import socket
-import threading
+import time
+import zlib
+from StringIO import StringIO
 from M2Crypto import SSL
 
 from rhsm.config import initConfig
 import rhsm.connection as connection
-from rhsm.profile import get_profile, RPMProfile
+from rhsm.profile import get_profile
 import subscription_manager.injection as inj
+from subscription_manager.cachestats import cache_stats
 from subscription_manager.jsonwrapper import PoolWrapper
 from rhsm import ourjson as json
 
@@ -38,8 +42,20 @@ log = logging.getLogger('rhsm-app.' + __name__)
 
 PACKAGES_RESOURCE = "packages"
 
+RPMDB_PATH = "/var/lib/rpm"
+
 cfg = initConfig()
 
+# First byte of zlib data, JSON text never starts with it
+ZLIB_HEADER = '\x78'
+
+
+def decode_cache_data(data):
+    """ Return the JSON of cache data, whether it was compressed or not. """
+    if data[:1] == ZLIB_HEADER:
+        return zlib.decompress(data)
+    return data
+
 
 class CacheManager(object):
     """
@@ -52,6 +68,10 @@ class CacheManager(object):
     # Fields the subclass must override:
     CACHE_FILE = None
 
+    # Write the cache as minified, zlib compressed JSON. Meant for caches
+    # of large server responses, the plain format is still read.
+    COMPRESS = False
+
     def to_dict(self):
         """
         Returns the data for this collection as a dict to be serialized
@@ -79,15 +99,32 @@ class CacheManager(object):
         """
         raise NotImplementedError
 
+    @classmethod
+    def _get_store(cls):
+        return inj.require(inj.CACHE_STORE)
+
     @classmethod
     def delete_cache(cls):
         """ Delete the cache for this collection from disk. """
-        if os.path.exists(cls.CACHE_FILE):
-            log.debug("Deleting cache: %s" % cls.CACHE_FILE)
-            os.remove(cls.CACHE_FILE)
+        log.debug("Deleting cache: %s" % cls.CACHE_FILE)
+        cls._get_store().delete(cls.CACHE_FILE)
+        cls._remove_legacy_cache_file()
+
+    @classmethod
+    def _remove_legacy_cache_file(cls):
+        """
+        Remove the file versions that kept each cache in its own file
+        left at CACHE_FILE, once the store has taken over its data.
+        """
+        try:
+            if os.path.exists(cls.CACHE_FILE):
+                os.remove(cls.CACHE_FILE)
+        except OSError, e:
+            log.debug("Unable to remove old cache file %s: %s" % (cls.CACHE_FILE, e))
 
     def _cache_exists(self):
-        return os.path.exists(self.CACHE_FILE)
+        return self._get_store().exists(self.CACHE_FILE) or \
+                os.path.exists(self.CACHE_FILE)
 
     def write_cache(self, debug=True):
         """
@@ -98,38 +135,74 @@ class CacheManager(object):
         required, but the method is exposed as some system data can be
         bundled up with the registration request, after which we need to
         manually write to disk.
+
+        Caches are kept in the shared CacheStore under their CACHE_FILE
+        name, which commits them right away.
         """
         # Logging in this method (when threaded) can cause a segfault, BZ 988861 and 988430
-        try:
-            if not os.access(os.path.dirname(self.CACHE_FILE), os.R_OK):
-                os.makedirs(os.path.dirname(self.CACHE_FILE))
-            f = open(self.CACHE_FILE, "w+")
-            json.dump(self.to_dict(), f, default=json.encode)
-            f.close()
-            if debug:
-                log.debug("Wrote cache: %s" % self.CACHE_FILE)
-        except IOError, e:
-            if debug:
-                log.error("Unable to write cache: %s" %
-                        self.CACHE_FILE)
-                log.exception(e)
+        self._get_store().put_many(self._recorded_store_items())
+        self._remove_legacy_cache_file()
+        if debug:
+            log.debug("Wrote cache: %s" % self.CACHE_FILE)
+
+    def _store_items(self):
+        """
+        Return the cache store entries write_cache() writes together, a
+        dict of name to data.
+        """
+        return {self.CACHE_FILE: self._encode(self.to_dict())}
+
+    def _recorded_store_items(self):
+        """ _store_items(), counted as a write in cache_stats. """
+        items = self._store_items()
+        cache_stats.record(self.CACHE_FILE, 'write',
+                           bytes_written=len(items.get(self.CACHE_FILE) or ''))
+        return items
+
+    def _encode(self, data):
+        if self.COMPRESS:
+            return zlib.compress(json.dumps(data, separators=(',', ':'),
+                                            default=json.encode))
+        return json.dumps(data, default=json.encode)
 
     def _read_cache(self):
         """
         Load the last data we sent to the server.
-        Returns none if no cache file exists.
+        Returns none if no cache exists.
         """
+        data = self._get_store().get(self.CACHE_FILE)
         try:
+            if data is not None:
+                loaded = self._load_data(StringIO(decode_cache_data(data)))
+                cache_stats.record(self.CACHE_FILE, 'hit', bytes_read=len(data))
+                return loaded
+
+            # Not written since the upgrade, use the old cache file
+            if not os.path.exists(self.CACHE_FILE):
+                cache_stats.record(self.CACHE_FILE, 'miss')
+                return None
             f = open(self.CACHE_FILE)
             data = self._load_data(f)
+            cache_stats.record(self.CACHE_FILE, 'hit', bytes_read=f.tell())
             f.close()
             return data
         except IOError:
             log.error("Unable to read cache: %s" % self.CACHE_FILE)
-        except ValueError:
+        except (ValueError, zlib.error):
             # ignore json file parse errors, we are going to generate
             # a new as if it didn't exist
             pass
+        cache_stats.record(self.CACHE_FILE, 'miss')
+
+    def _cache_mtime(self):
+        """
+        Return when the cache was last written, in seconds since the
+        epoch, or None if it does not exist.
+        """
+        mtime = self._get_store().mtime(self.CACHE_FILE)
+        if mtime is None and os.path.exists(self.CACHE_FILE):
+            mtime = os.stat(self.CACHE_FILE).st_mtime
+        return mtime
 
     def update_check(self, uep, consumer_uuid, force=False):
         """
@@ -139,7 +212,7 @@ class CacheManager(object):
         if self.has_changed() or force:
             log.debug("System data has changed, updating server.")
             try:
-                self._sync_with_server(uep, consumer_uuid)
+                self._timed_sync(uep, consumer_uuid)
                 self.write_cache()
                 # Return the number of 'updates' we did, assuming updating all
                 # packages at once is one update.
@@ -153,22 +226,48 @@ class CacheManager(object):
                         "for more details."))
         else:
             log.debug("No changes.")
+            cache_stats.record(self.CACHE_FILE, 'unchanged')
             return 0  # No updates performed.
 
+    def _timed_sync(self, uep, consumer_uuid):
+        """ _sync_with_server(), counted and timed in cache_stats. """
+        start = time.time()
+        try:
+            self._sync_with_server(uep, consumer_uuid)
+        except Exception:
+            cache_stats.record(self.CACHE_FILE, 'error', sync_time=time.time() - start)
+            raise
+        cache_stats.record(self.CACHE_FILE, 'sync', sync_time=time.time() - start)
+
 
 class StatusCache(CacheManager):
     """
     Unlike other cache managers, this one gets info from the server rather
     than sending it.
+
+    A cached status younger than CACHE_TTL seconds (or the rhsm.conf
+    CACHE_TTL_OPTION setting) is served without asking the server, as
+    long as the consumer and the local state it depends on, see
+    _local_state(), have not changed since it was written.
     """
+    # 0 always asks the server
+    CACHE_TTL = 0
+    CACHE_TTL_OPTION = None
+
     def __init__(self):
         self.server_status = None
         self.last_error = None
+        # _local_state() when server_status was fetched, the write to the
+        # store is queued and may only happen once it has changed
+        self._fetched_state = None
 
     def load_status(self, uep, uuid):
         """
         Load status from wherever is appropriate.
 
+        If the cache is still fresh, return it without contacting the
+        server.
+
         If server is reachable, return it's response
         and cache the results to disk.
 
@@ -177,8 +276,19 @@ class StatusCache(CacheManager):
 
         Returns None if we cannot reach the server, or use the cache.
         """
+        if self._is_fresh():
+            status = self._read_cache()
+            if status is not None:
+                log.debug("Using fresh cache: %s" % self.CACHE_FILE)
+                cache_stats.record(self.CACHE_FILE, 'fresh')
+                self.last_error = False
+                return status
+
         try:
-            self._sync_with_server(uep, uuid)
+            # taken before asking, a change while waiting on the server
+            # leaves the status stale
+            self._fetched_state = self._local_state()
+            self._timed_sync(uep, uuid)
             self.write_cache()
             self.last_error = False
             return self.server_status
@@ -264,19 +374,80 @@ class StatusCache(CacheManager):
 
     def write_cache(self):
         """
-        This is threaded because it should never block in runtime.
-        Writing to disk means it will be read from memory for the rest of this run.
+        This is queued to the cache store's background writer because it
+        should never block in runtime. Writing to disk means it will be
+        read from memory for the rest of this run.
         """
-        threading.Thread(target=super(StatusCache, self).write_cache,
-                         args=[True],
-                         name="WriteCache%sThread" % self.__class__.__name__).start()
-        log.debug("Started thread to write cache: %s" % self.CACHE_FILE)
+        self._get_store().put_async(self.CACHE_FILE, self._recorded_store_items)
+        # The queued status is what this process reads from now on, and
+        # a status can always be fetched from the server again.
+        self._remove_legacy_cache_file()
+        log.debug("Queued cache write: %s" % self.CACHE_FILE)
 
     # we override a @classmethod with an instance method in the sub class?
     def delete_cache(self):
         super(StatusCache, self).delete_cache()
+        self._get_store().delete(self._state_name())
         self.server_status = None
 
+    def _get_ttl(self):
+        if self.CACHE_TTL_OPTION and cfg.has_option('rhsm', self.CACHE_TTL_OPTION):
+            try:
+                return cfg.get_int('rhsm', self.CACHE_TTL_OPTION) or 0
+            except ValueError:
+                log.warn("Invalid value for rhsm.%s, using %s." %
+                         (self.CACHE_TTL_OPTION, self.CACHE_TTL))
+        return self.CACHE_TTL
+
+    def _state_name(self):
+        return "%s.state" % self.CACHE_FILE
+
+    def _local_state(self):
+        """
+        Return a string describing the local state this status depends on,
+        a cache written with a different one is never served as fresh.
+        By default that is just the consumer.
+        """
+        return inj.require(inj.IDENTITY).uuid or ''
+
+    def _store_items(self):
+        items = super(StatusCache, self)._store_items()
+        state = self._fetched_state
+        if state is None:
+            state = self._local_state()
+        items[self._state_name()] = state
+        return items
+
+    def _is_fresh(self):
+        ttl = self._get_ttl()
+        if ttl <= 0:
+            return False
+
+        store = self._get_store()
+        written = store.mtime(self.CACHE_FILE)
+        if written is None:
+            return False
+        if not 0 <= time.time() - written < ttl or \
+                store.get(self._state_name()) != self._local_state():
+            cache_stats.record(self.CACHE_FILE, 'stale')
+            return False
+        return True
+
+
+def _cert_dirs_state(state):
+    """
+    Add the mtimes of the entitlement and product certificate directories
+    to a StatusCache local state, attaching, removing or installing
+    certificates changes them.
+    """
+    mtimes = []
+    for feature in (inj.ENT_DIR, inj.PROD_DIR):
+        try:
+            mtimes.append(repr(os.stat(inj.require(feature).path).st_mtime))
+        except (OSError, AttributeError):
+            mtimes.append('')
+    return " ".join([state] + mtimes)
+
 
 class EntitlementStatusCache(StatusCache):
     """
@@ -285,16 +456,25 @@ class EntitlementStatusCache(StatusCache):
     than sending it.
     """
     CACHE_FILE = "/var/lib/rhsm/cache/entitlement_status.json"
+    CACHE_TTL = 60
+    CACHE_TTL_OPTION = "entitlement_status_cache_ttl"
+    COMPRESS = True
 
     def _sync_with_server(self, uep, uuid):
         self.server_status = uep.getCompliance(uuid)
 
+    def _local_state(self):
+        return _cert_dirs_state(super(EntitlementStatusCache, self)._local_state())
+
 
 class ProductStatusCache(StatusCache):
     """
     Manages the system cache of installed product valid date ranges.
     """
     CACHE_FILE = "/var/lib/rhsm/cache/product_status.json"
+    CACHE_TTL = 60
+    CACHE_TTL_OPTION = "product_status_cache_ttl"
+    COMPRESS = True
 
     def _sync_with_server(self, uep, uuid):
         consumer_data = uep.getConsumer(uuid)
@@ -304,12 +484,17 @@ class ProductStatusCache(StatusCache):
         else:
             self.server_status = consumer_data['installedProducts']
 
+    def _local_state(self):
+        return _cert_dirs_state(super(ProductStatusCache, self)._local_state())
+
 
 class OverrideStatusCache(StatusCache):
     """
     Manages the cache of yum repo overrides set on the server.
     """
     CACHE_FILE = "/var/lib/rhsm/cache/content_overrides.json"
+    CACHE_TTL = 60
+    CACHE_TTL_OPTION = "content_overrides_cache_ttl"
 
     def _sync_with_server(self, uep, consumer_uuid):
         self.server_status = uep.getContentOverrides(consumer_uuid)
@@ -320,6 +505,8 @@ class ReleaseStatusCache(StatusCache):
     Manages the cache of the consumers 'release' setting applied to yum repos.
     """
     CACHE_FILE = "/var/lib/rhsm/cache/releasever.json"
+    CACHE_TTL = 60
+    CACHE_TTL_OPTION = "release_cache_ttl"
 
     def _sync_with_server(self, uep, consumer_uuid):
         def get_release(uuid):
@@ -334,18 +521,69 @@ class ReleaseStatusCache(StatusCache):
     # we are yum specific, and not triggered till late.
 
 
+def rpmdb_fingerprint(rpmdb_path=None):
+    """
+    Return a cheap fingerprint of the rpm database, the name, size and
+    mtime of each of its files, or None if it can not be read.
+
+    Any rpm transaction rewrites at least one of them. The Berkeley DB
+    environment files (__db.*) and lock files are skipped, they are
+    touched by plain queries too.
+    """
+    rpmdb_path = rpmdb_path or RPMDB_PATH
+    try:
+        fingerprint = []
+        for name in sorted(os.listdir(rpmdb_path)):
+            if name.startswith('__db.') or name.startswith('.'):
+                continue
+            st = os.stat(os.path.join(rpmdb_path, name))
+            fingerprint.append("%s %d %r" % (name, st.st_size, st.st_mtime))
+    except OSError, e:
+        log.debug("Unable to fingerprint rpm database: %s" % e)
+        return None
+    return "\n".join(fingerprint)
+
+
+PACKAGE_KEY_FIELDS = ('name', 'epoch', 'version', 'release', 'arch', 'vendor')
+
+
+def package_key(package):
+    """ One line identifying a package dict from RPMProfile.collect(). """
+    return "\t".join([unicode(package.get(field) or '') for field in PACKAGE_KEY_FIELDS]).encode('utf-8')
+
+
+def package_profile_digest(package_keys):
+    """ Digest of a package profile, given the package_key() of each package. """
+    return hashlib.sha256("\n".join(sorted(package_keys))).hexdigest()
+
+
 # this is injected normally
 class ProfileManager(CacheManager):
     """
     Manages the profile of packages installed on this system.
+
+    The cache only holds a digest of the last uploaded profile, which is
+    all has_changed() needs. The package keys of that profile are kept
+    in a separate, compressed entry. It is only read once the digest
+    differs, to work out which packages were added and removed since the
+    last upload, see get_package_changes().
     """
     CACHE_FILE = "/var/lib/rhsm/packages/packages.json"
 
+    # Fingerprint of the rpm database the cached profile was taken from
+    RPMDB_FINGERPRINT = "/var/lib/rhsm/packages/rpmdb_fingerprint"
+
+    # Package keys of the cached profile
+    PACKAGE_KEYS = "/var/lib/rhsm/packages/package_keys"
+
     def __init__(self, current_profile=None):
 
         # Could be None, we'll read the system's current profile later once
         # we're sure we actually need the data.
         self._current_profile = current_profile
+        self._current_keys = None
+        self._rpmdb_fingerprint = None
+        self._package_changes = None
         self._report_package_profile = cfg.get_int('rhsm', 'report_package_profile')
 
     # give tests a chance to use something other than RPMProfile
@@ -355,11 +593,22 @@ class ProfileManager(CacheManager):
     def _get_current_profile(self):
         # If we weren't given a profile, load the current systems packages:
         if not self._current_profile:
+            # Taken first, so an rpm transaction that runs while we read
+            # the profile still shows up as a change next time.
+            self._rpmdb_fingerprint = rpmdb_fingerprint()
             self._current_profile = self._get_profile('rpm')
         return self._current_profile
 
     def _set_current_profile(self, value):
         self._current_profile = value
+        self._current_keys = None
+        self._package_changes = None
+
+    def _get_current_keys(self):
+        if self._current_keys is None:
+            self._current_keys = [package_key(package) for package in
+                                  self.current_profile.collect()]
+        return self._current_keys
 
     def _set_report_package_profile(self, value):
         self._report_package_profile = value
@@ -367,10 +616,16 @@ class ProfileManager(CacheManager):
     current_profile = property(_get_current_profile, _set_current_profile)
 
     def to_dict(self):
-        return self.current_profile.collect()
+        keys = self._get_current_keys()
+        return {'digest': package_profile_digest(keys), 'count': len(keys)}
 
     def _load_data(self, open_file):
-        return RPMProfile(from_file=open_file)
+        """ Return the digest of the cached profile. """
+        data = json.loads(open_file.read())
+        if isinstance(data, list):
+            # Full profile written by older versions
+            return package_profile_digest([package_key(package) for package in data])
+        return data['digest']
 
     def update_check(self, uep, consumer_uuid, force=False):
         """
@@ -393,10 +648,76 @@ class ProfileManager(CacheManager):
             log.debug("Cache does not exist")
             return True
 
-        cached_profile = self._read_cache()
-        return not cached_profile == self.current_profile
+        if self._rpmdb_unchanged():
+            log.debug("rpm database has not changed since the cached profile")
+            return False
+
+        cached_digest = self._read_cache()
+        if cached_digest != package_profile_digest(self._get_current_keys()):
+            added, removed = self.get_package_changes()
+            log.debug("Package profile changed, %s packages added and %s removed" %
+                      (len(added), len(removed)))
+            return True
+
+        # The rpm database was rewritten without changing the packages,
+        # take its new fingerprint so the next check is short again.
+        if self._rpmdb_fingerprint is not None:
+            self._get_store().put(self.RPMDB_FINGERPRINT, self._rpmdb_fingerprint)
+        return False
+
+    def _rpmdb_unchanged(self):
+        """
+        Check whether the rpm database still matches the fingerprint it had
+        when the cached profile was taken, so the current profile does not
+        need to be read at all.
+        """
+        # A profile we were given is always compared
+        if self._current_profile:
+            return False
+
+        cached = self._get_store().get(self.RPMDB_FINGERPRINT)
+        return cached is not None and cached == rpmdb_fingerprint()
+
+    def get_package_changes(self):
+        """
+        Return the package keys added to and removed from the profile
+        since the cached one, as two sorted lists.
+        """
+        if self._package_changes is None:
+            data = self._get_store().get(self.PACKAGE_KEYS)
+            previous = set()
+            if data is not None:
+                try:
+                    previous = set(zlib.decompress(data).splitlines())
+                except zlib.error:
+                    log.debug("Ignoring unreadable cache: %s" % self.PACKAGE_KEYS)
+            current = set(self._get_current_keys())
+            self._package_changes = (sorted(current - previous),
+                                     sorted(previous - current))
+        return self._package_changes
+
+    def _store_items(self):
+        items = super(ProfileManager, self)._store_items()
+        items[self.PACKAGE_KEYS] = zlib.compress("\n".join(sorted(self._get_current_keys())))
+        if self._rpmdb_fingerprint is not None:
+            items[self.RPMDB_FINGERPRINT] = self._rpmdb_fingerprint
+        return items
+
+    def write_cache(self, debug=True):
+        if self._rpmdb_fingerprint is None:
+            self._get_store().delete(self.RPMDB_FINGERPRINT)
+        super(ProfileManager, self).write_cache(debug)
+
+    @classmethod
+    def delete_cache(cls):
+        super(ProfileManager, cls).delete_cache()
+        cls._get_store().delete(cls.RPMDB_FINGERPRINT)
+        cls._get_store().delete(cls.PACKAGE_KEYS)
 
     def _sync_with_server(self, uep, consumer_uuid):
+        added, removed = self.get_package_changes()
+        log.info("Uploading package profile, %s packages added and %s removed "
+                 "since the last upload" % (len(added), len(removed)))
         uep.updatePackageProfile(consumer_uuid,
                 self.current_profile.collect())
 
@@ -405,12 +726,19 @@ class InstalledProductsManager(CacheManager):
     """
     Manages the cache of the products installed on this system, and what we
     last sent to the server.
+
+    The installed products, their tags and the list sent to the server are
+    only rebuilt when the generation of the product directory moved.
     """
     CACHE_FILE = "/var/lib/rhsm/cache/installed_products.json"
 
     def __init__(self):
         self._installed = None
         self.tags = None
+        # installed product list for the server, and the product directory
+        # generation it was all built from
+        self._server_payload = None
+        self._generation = None
 
         self.product_dir = inj.require(inj.PROD_DIR)
 
@@ -426,6 +754,7 @@ class InstalledProductsManager(CacheManager):
 
     def _set_installed(self, value):
         self._installed = value
+        self._server_payload = None
 
     installed = property(_get_installed, _set_installed)
 
@@ -467,6 +796,10 @@ class InstalledProductsManager(CacheManager):
         Format installed product data to match the cache
         and what the server can use.
         """
+        generation = self.product_dir.generation()
+        if self._installed is not None and generation == self._generation:
+            return
+
         self._installed = {}
         self.tags = set()
         for prod_cert in self.product_dir.list():
@@ -477,6 +810,8 @@ class InstalledProductsManager(CacheManager):
                     'version': prod.version,
                     'arch': ','.join(prod.architectures)
                     }
+        self._server_payload = None
+        self._generation = generation
 
     def format_for_server(self):
         """
@@ -485,8 +820,9 @@ class InstalledProductsManager(CacheManager):
         consumer.
         """
         self._setup_installed()
-        final = [val for (key, val) in self.installed.items()]
-        return final
+        if self._server_payload is None:
+            self._server_payload = [val for (key, val) in self.installed.items()]
+        return self._server_payload
 
     def _sync_with_server(self, uep, consumer_uuid):
         uep.updateConsumer(consumer_uuid,
@@ -495,12 +831,23 @@ class InstalledProductsManager(CacheManager):
 
 
 class PoolTypeCache(object):
+    """
+    Map of pool ids to pool types, for the pools of attached entitlements.
+
+    The map is kept in the CacheStore with the serials of the entitlements
+    that were attached when it was written, and reused by new processes
+    for as long as the same entitlements are attached, so they do not have
+    to fetch the entitlement list from the server.
+    """
+
+    CACHE_FILE = "/var/lib/rhsm/cache/pool_types.json"
 
     def __init__(self):
         self.identity = inj.require(inj.IDENTITY)
         self.cp_provider = inj.require(inj.CP_PROVIDER)
         self.ent_dir = inj.require(inj.ENT_DIR)
         self.pooltype_map = {}
+        self._load()
         self.update()
 
     def get(self, pool_id):
@@ -527,21 +874,44 @@ class PoolTypeCache(object):
                 # In this case, return an empty map.  We just won't populate the field
                 log.debug('Problem attmepting to get entitlements from the server')
                 log.debug(e)
+                return
 
             for ent in entitlement_list:
                 pool = PoolWrapper(ent.get('pool', {}))
                 pool_type = pool.get_pool_type()
                 result[pool.get_id()] = pool_type
 
-        self.pooltype_map.update(result)
+            self.pooltype_map.update(result)
+            self._write()
 
     def update_from_pools(self, pool_map):
         # pool_map maps pool ids to pool json
         for pool_id in pool_map:
             self.pooltype_map[pool_id] = PoolWrapper(pool_map[pool_id]).get_pool_type()
+        self._write()
 
     def clear(self):
         self.pooltype_map = {}
+        inj.require(inj.CACHE_STORE).delete(self.CACHE_FILE)
+
+    def _attached_serials(self):
+        return sorted(str(ent.serial) for ent in self.ent_dir.list())
+
+    def _load(self):
+        data = inj.require(inj.CACHE_STORE).get(self.CACHE_FILE)
+        if data is None:
+            return
+        try:
+            cached = json.loads(data)
+            if cached['serials'] == self._attached_serials():
+                self.pooltype_map.update(cached['pool_types'])
+        except (ValueError, KeyError, TypeError):
+            log.debug("Ignoring unreadable cache: %s" % self.CACHE_FILE)
+
+    def _write(self):
+        data = {'serials': self._attached_serials(),
+                'pool_types': self.pooltype_map}
+        inj.require(inj.CACHE_STORE).put(self.CACHE_FILE, json.dumps(data))
 
 
 class WrittenOverrideCache(CacheManager):
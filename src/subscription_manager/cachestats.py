@@ -0,0 +1,107 @@
+#
+# Copyright (c) 2015 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+"""
+Counters and timers for the caches in subscription_manager.cache.
+
+Every CacheManager records what happens to its cache in cache_stats,
+per cache, for the life of the process:
+
+ - hit / miss: _read_cache() found cached data, or found none
+ - fresh / stale: a StatusCache was served from a cache still within its
+   TTL, or had one that was too old or written for another local state
+ - unchanged: update_check() found nothing to push
+ - sync / error: a successful or failed exchange with the server, with
+   the time spent in sync_time
+ - write: the cache was written, with the size in bytes_written
+
+The totals are logged when the process exits.
+"""
+
+import atexit
+import logging
+import threading
+
+log = logging.getLogger('rhsm-app.' + __name__)
+
+COUNTERS = ('hit', 'miss', 'fresh', 'stale', 'unchanged', 'sync', 'error', 'write')
+TOTALS = ('bytes_read', 'bytes_written', 'sync_time')
+
+
+class CacheStats(object):
+    """
+    Counters and totals per cache name, safe to update from any thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, cache, event, **totals):
+        """
+        Count event, one of COUNTERS, for cache and add the given TOTALS.
+
+        Called from the cache store's writer thread too, so it must not log.
+        """
+        self._lock.acquire()
+        try:
+            stats = self._stats.get(cache)
+            if stats is None:
+                stats = self._stats[cache] = dict.fromkeys(COUNTERS + TOTALS, 0)
+            stats[event] += 1
+            for name, value in totals.items():
+                stats[name] += value
+        finally:
+            self._lock.release()
+
+    def get(self, cache=None):
+        """
+        Return a copy of the stats of cache, or of every cache as a dict of
+        cache name -> stats.
+        """
+        self._lock.acquire()
+        try:
+            if cache is not None:
+                return dict(self._stats.get(cache) or dict.fromkeys(COUNTERS + TOTALS, 0))
+            return dict((name, dict(stats)) for name, stats in self._stats.items())
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._stats = {}
+        finally:
+            self._lock.release()
+
+    def summary(self):
+        """ Return one line of stats per cache, sorted by cache name. """
+        lines = []
+        for cache, stats in sorted(self.get().items()):
+            fields = ["%s=%s" % (name, stats[name]) for name in COUNTERS + TOTALS[:2]]
+            fields.append("sync_time=%.3fs" % stats['sync_time'])
+            lines.append("%s: %s" % (cache, " ".join(fields)))
+        return lines
+
+    def log_summary(self):
+        for line in self.summary():
+            log.debug("Cache stats %s" % line)
+
+
+cache_stats = CacheStats()
+
+# Registered before the cache store's exit flush, as cache.py imports this
+# first, so it runs after it and includes the writes done there.
+atexit.register(cache_stats.log_summary)
@@ -0,0 +1,303 @@
+#
+# Copyright (c) 2015 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+"""
+Single on disk store for the caches in subscription_manager.cache.
+
+Every cache used to be its own JSON file, rewritten in place on every
+update. They now all live in one sqlite database, one row per cache.
+Each write is committed in its own transaction, so other processes see
+it straight away and it survives the writer being killed. The entries
+of one put_many() call are committed together.
+
+Caches that should not block the caller while they are serialized are
+queued with put_async() and written by the store's one background
+writer thread.
+"""
+
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger('rhsm-app.' + __name__)
+
+CACHE_STORE_FILE = "/var/lib/rhsm/cache/rhsm_cache.db"
+
+# Stores with writes that still need to be committed at exit.
+_open_stores = set()
+
+
+def _flush_open_stores():
+    for store in list(_open_stores):
+        store.flush()
+
+atexit.register(_flush_open_stores)
+
+
+class CacheStore(object):
+    """
+    Key/value store of cache data, backed by a sqlite database.
+
+    Writes are committed as they are made. A write that can not be
+    committed, for example because the database is locked or read only,
+    is kept in memory, so get() still sees it, and is retried by flush()
+    and at exit.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or CACHE_STORE_FILE
+        # name -> (data, updated) of writes still to be committed, data
+        # is None for a deleted cache
+        self._pending = {}
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+        # name -> callable returning a dict of entries to stage, and the
+        # order they were queued in
+        self._queued = {}
+        self._queue_order = []
+        self._writing = None
+        self._queue_cond = threading.Condition(threading.Lock())
+        self._writer = None
+
+    def get(self, name):
+        """ Return the data stored for name, or None. """
+        row = self._lookup(name)
+        return row and row[0]
+
+    def exists(self, name):
+        return self.get(name) is not None
+
+    def mtime(self, name):
+        """ Return when the data for name was last written, or None. """
+        row = self._lookup(name)
+        return row and row[1]
+
+    def put(self, name, data):
+        self.put_many({name: data})
+
+    def put_many(self, items):
+        """ Commit the data of several caches together, dict of name -> data. """
+        now = time.time()
+        self._commit(dict((name, (data, now)) for name, data in items.items()))
+
+    def delete(self, name):
+        self._commit({name: (None, None)})
+
+    def put_async(self, name, producer):
+        """
+        Queue producer, a callable returning a dict of name -> data, to be
+        committed by the background writer thread.
+
+        Writes queued under the same name replace each other until the
+        writer gets to them, so only the last one is done. Reading name,
+        run_queued() and process exit all handle it right away.
+        """
+        self._queue_cond.acquire()
+        try:
+            if name not in self._queued:
+                self._queue_order.append(name)
+            self._queued[name] = producer
+            _open_stores.add(self)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_queued,
+                                                name="CacheStoreWriterThread")
+                self._writer.setDaemon(True)
+                self._writer.start()
+            self._queue_cond.notifyAll()
+        finally:
+            self._queue_cond.release()
+
+    def run_queued(self, name=None):
+        """
+        Commit the queued write for name, or every queued write, in this
+        thread, after the one the writer is busy with if it is the same.
+        """
+        if threading.currentThread() is self._writer:
+            return
+
+        while True:
+            self._queue_cond.acquire()
+            try:
+                while self._writing is not None and name in (None, self._writing):
+                    self._queue_cond.wait()
+                if name is None:
+                    if not self._queue_order:
+                        return
+                    next_name = self._queue_order[0]
+                elif name in self._queued:
+                    next_name = name
+                else:
+                    return
+                producer = self._dequeue(next_name)
+            finally:
+                self._queue_cond.release()
+            self._stage(next_name, producer)
+
+    def flush(self):
+        """ Commit all queued writes, and retry the ones that failed. """
+        self.run_queued()
+
+        self._lock.acquire()
+        try:
+            pending, self._pending = self._pending, {}
+            if not self._queued and self._writing is None:
+                _open_stores.discard(self)
+        finally:
+            self._lock.release()
+
+        self._commit(pending)
+
+    def close(self):
+        """ Commit outstanding writes and close this thread's connection. """
+        self.flush()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _commit(self, pending):
+        """
+        Commit pending, a dict of name -> (data, updated), in one
+        transaction. If that fails the writes are kept to retry later.
+        """
+        if not pending:
+            return
+
+        # Earlier failed writes of the same names are replaced
+        self._lock.acquire()
+        try:
+            for name in pending:
+                self._pending.pop(name, None)
+        finally:
+            self._lock.release()
+
+        try:
+            conn = self._connect(create=True)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for name, (data, updated) in pending.items():
+                    if data is None:
+                        conn.execute("DELETE FROM cache WHERE name = ?", (name,))
+                    else:
+                        conn.execute("INSERT OR REPLACE INTO cache (name, data, updated) "
+                                     "VALUES (?, ?, ?)",
+                                     (name, sqlite3.Binary(data), updated))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        except (sqlite3.Error, OSError, IOError), e:
+            # Logging from the writer thread has caused segfaults,
+            # BZ 988861 and 988430.
+            if threading.currentThread() is not self._writer:
+                log.warn("Unable to write cache store %s: %s" % (self.path, e))
+            # Keep serving them in this process, unless replaced since
+            self._lock.acquire()
+            try:
+                for name, entry in pending.items():
+                    self._pending.setdefault(name, entry)
+                _open_stores.add(self)
+            finally:
+                self._lock.release()
+
+    def _dequeue(self, name):
+        self._queue_order.remove(name)
+        return self._queued.pop(name)
+
+    def _stage(self, name, producer):
+        try:
+            self.put_many(producer())
+        except Exception, e:
+            # Logging from the writer thread has caused segfaults,
+            # BZ 988861 and 988430.
+            if threading.currentThread() is not self._writer:
+                log.warn("Unable to write queued cache %s: %s" % (name, e))
+
+    def _write_queued(self):
+        while True:
+            self._queue_cond.acquire()
+            try:
+                while not self._queue_order:
+                    self._queue_cond.wait()
+                name = self._writing = self._queue_order[0]
+                producer = self._dequeue(name)
+            finally:
+                self._queue_cond.release()
+
+            self._stage(name, producer)
+
+            self._queue_cond.acquire()
+            try:
+                self._writing = None
+                self._queue_cond.notifyAll()
+            finally:
+                self._queue_cond.release()
+
+    def _lookup(self, name):
+        self.run_queued(name)
+        self._lock.acquire()
+        try:
+            if name in self._pending:
+                data, updated = self._pending[name]
+                if data is None:
+                    return None
+                return (data, updated)
+        finally:
+            self._lock.release()
+
+        if not os.path.exists(self.path):
+            return None
+        try:
+            row = self._connect().execute(
+                "SELECT data, updated FROM cache WHERE name = ?", (name,)).fetchone()
+        except sqlite3.Error, e:
+            log.warn("Unable to read cache store %s: %s" % (self.path, e))
+            return None
+        if row is None:
+            return None
+        return (str(row[0]), row[1])
+
+    def _connect(self, create=False):
+        # sqlite connections can not be shared between threads, and
+        # StatusCache writes from its own.
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+
+        store_dir = os.path.dirname(self.path)
+        if create and not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache "
+                         "(name TEXT PRIMARY KEY, data BLOB, updated REAL)")
+        except sqlite3.OperationalError:
+            # Read only, nothing was ever written there
+            pass
+        except sqlite3.DatabaseError, e:
+            # Not a database at all, it only holds caches so start over
+            conn.close()
+            log.warn("Replacing unreadable cache store %s: %s" % (self.path, e))
+            os.remove(self.path)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("CREATE TABLE IF NOT EXISTS cache "
+                         "(name TEXT PRIMARY KEY, data BLOB, updated REAL)")
+        self._local.conn = conn
+        return conn
+
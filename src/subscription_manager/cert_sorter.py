@@ -219,30 +219,27 @@ class ComplianceManager(object):
         unknown_products = dict((k, v) for (k, v) in self.installed_products.items() if
                                 k not in self.valid_products.keys() and
                                 k not in self.partially_valid_products.keys())
-        ent_certs = self.entitlement_dir.list()
-
         on_date = datetime.now(GMT())
-        for ent_cert in ent_certs:
-
-            # Builds the list of valid entitlement certs today:
-            if ent_cert.is_valid():
-                self.valid_entitlement_certs.append(ent_cert)
-
-            for product in ent_cert.products:
-                if product.id in unknown_products.keys():
-                    # If the entitlement starts after the date we're checking, we
-                    # consider this a future entitlement. Technically it could be
-                    # partially stacked on that date, but we cannot determine that
-                    # without recursively cert sorting again on that date.
-                    if ent_cert.valid_range.begin() > on_date:
-                        product_dict = self.future_products
-                    # Check if entitlement has already expired:
-                    elif ent_cert.valid_range.end() < on_date:
-                        product_dict = self.expired_products
-                    else:
-                        continue
-
-                    product_dict.setdefault(product.id, []).append(ent_cert)
+
+        # Builds the list of valid entitlement certs today:
+        self.valid_entitlement_certs.extend(
+            self.entitlement_dir.get_date_index().valid_on(on_date))
+
+        for product_id in unknown_products:
+            for ent_cert in self.entitlement_dir.list_for_product(product_id):
+                # If the entitlement starts after the date we're checking, we
+                # consider this a future entitlement. Technically it could be
+                # partially stacked on that date, but we cannot determine that
+                # without recursively cert sorting again on that date.
+                if ent_cert.valid_range.begin() > on_date:
+                    product_dict = self.future_products
+                # Check if entitlement has already expired:
+                elif ent_cert.valid_range.end() < on_date:
+                    product_dict = self.expired_products
+                else:
+                    continue
+
+                product_dict.setdefault(product_id, []).append(ent_cert)
 
     def get_system_status(self):
         return STATUS_MAP.get(self.system_status, STATUS_MAP['unknown'])
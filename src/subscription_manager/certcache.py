@@ -0,0 +1,293 @@
+#
+# Copyright (c) 2015 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+"""
+On disk cache of parsed certificates.
+
+Every entry point (yum plugins, rhsmcertd, the CLI and GUI) lists the
+entitlement and product certificate directories, and fully parsing the
+X.509 PEM of every certificate is most of their startup cost. The cache
+here keeps the parsed certificate objects of a certificate directory on
+disk, keyed by each file's inode, size and mtime, so certificates that
+have not changed are not parsed again by the next process.
+
+Cached certificates are handed out as LazyCertificate objects, which
+answer the few attributes most callers need (serial, path, validity dates,
+pool, key path) straight from the cache, and only unpickle the full
+certificate, with its order, products and content, when anything else is
+used.
+"""
+
+import copy
+import cPickle as pickle
+import logging
+import os
+import stat
+import tempfile
+
+from rhsm import certificate2
+from rhsm.certificate import create_from_file
+
+log = logging.getLogger('rhsm-app.' + __name__)
+
+CERT_CACHE_DIR = "/var/lib/rhsm/cache/certificates"
+
+# Certificate attributes kept outside of the pickled certificate, so they
+# can be read without loading it.
+LAZY_ATTRIBUTES = ('path', 'serial', 'start', 'end', 'valid_range', 'version', 'pool')
+
+
+def _rhsm_stamp():
+    """
+    Identify the installed python-rhsm. Pickled certificates reference its
+    classes, so a cache written by another version is not trusted.
+    """
+    try:
+        return os.stat(certificate2.__file__).st_mtime
+    except (AttributeError, OSError):
+        return None
+
+
+class CertificateCache(object):
+    """
+    Persistent cache of the parsed certificates of one certificate directory.
+
+    Entries are stored per file name along with the (inode, size, mtime)
+    of the file they were parsed from. A lookup with a different stat key
+    is a miss, so a rewritten or replaced certificate is parsed again.
+    """
+
+    # Bump when the layout of the cache file changes.
+    VERSION = 3
+
+    def __init__(self, cert_dir_path, cache_dir=None):
+        self.cert_dir_path = cert_dir_path
+        cache_dir = cache_dir or CERT_CACHE_DIR
+        name = cert_dir_path.strip(os.sep).replace(os.sep, '_') or 'root'
+        self.cache_file = os.path.join(cache_dir, "%s.pickle" % name)
+        self._entries = None
+        self._dirty = False
+
+    @staticmethod
+    def stat_key(path):
+        """
+        Return the key a cached certificate for path is valid for, or None
+        if the file can not be stat'ed.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def get(self, path, stat_key):
+        """
+        Return a LazyCertificate for the cached certificate for path, or
+        None if it is not cached or the file changed since it was cached.
+        """
+        if stat_key is None:
+            return None
+
+        entry = self._get_entries().get(os.path.basename(path))
+        if entry is None or entry[0] != stat_key:
+            return None
+        return LazyCertificate(path, entry[1], entry[2])
+
+    def put(self, path, stat_key, cert):
+        """
+        Cache the certificate parsed from path, stat_key should be taken
+        before the file was parsed.
+        """
+        if stat_key is None:
+            return
+
+        state = copy.copy(cert)
+        # The raw X509 object wraps a C struct that can not be pickled,
+        # nothing outside of python-rhsm's parsing uses it.
+        if hasattr(state, 'x509'):
+            state.x509 = None
+
+        try:
+            blob = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            log.debug("Unable to cache certificate %s: %s" % (path, e))
+            return
+
+        attributes = vars(state)
+        header = dict((name, attributes[name]) for name in LAZY_ATTRIBUTES
+                      if name in attributes)
+        if callable(getattr(state, 'key_path', None)):
+            header['_key_path'] = state.key_path()
+        header['_cert_class'] = state.__class__
+
+        self._get_entries()[os.path.basename(path)] = (stat_key, header, blob)
+        self._dirty = True
+
+    def prune(self, filenames):
+        """
+        Forget all cached certificates whose file name is not in filenames.
+        """
+        entries = self._get_entries()
+        for filename in set(entries) - set(filenames):
+            del entries[filename]
+            self._dirty = True
+
+    def write(self):
+        """
+        Atomically write the cache to disk, if anything changed.
+        """
+        if not self._dirty:
+            return
+
+        cache_dir = os.path.dirname(self.cache_file)
+        tmp_path = None
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.certcache')
+            f = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump((self.VERSION, _rhsm_stamp(), self._entries), f,
+                            pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp_path, self.cache_file)
+            self._dirty = False
+        except (IOError, OSError), e:
+            log.debug("Unable to write certificate cache %s: %s" % (self.cache_file, e))
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def delete(self):
+        """ Remove the cache from disk and memory. """
+        self._entries = {}
+        self._dirty = False
+        if os.path.exists(self.cache_file):
+            os.remove(self.cache_file)
+
+    def _get_entries(self):
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def _read(self):
+        try:
+            st = os.stat(self.cache_file)
+        except OSError:
+            return {}
+
+        # Unpickling runs code, only trust a cache nobody else could have written.
+        if st.st_uid not in (0, os.geteuid()) or \
+                st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            log.warn("Ignoring certificate cache with unsafe ownership or permissions: %s" %
+                     self.cache_file)
+            return {}
+
+        try:
+            f = open(self.cache_file, 'rb')
+            try:
+                version, stamp, entries = pickle.load(f)
+            finally:
+                f.close()
+        except Exception, e:
+            log.debug("Ignoring unreadable certificate cache %s: %s" % (self.cache_file, e))
+            return {}
+
+        if version != self.VERSION or stamp != _rhsm_stamp():
+            log.debug("Ignoring outdated certificate cache: %s" % self.cache_file)
+            return {}
+        return entries
+
+
+class LazyCertificate(object):
+    """
+    Stand-in for a cached certificate.
+
+    The attributes in LAZY_ATTRIBUTES, and key_path() for entitlement
+    certificates, are served from the cache entry. The full certificate
+    is unpickled, or parsed again if that fails, the first time anything
+    else is used, and all other attribute access is passed on to it.
+
+    It reports the class of the cached certificate as its __class__, so
+    isinstance() checks against the rhsm certificate classes hold without
+    loading it.
+    """
+
+    def __init__(self, path, header, blob):
+        self.__dict__.update(header)
+        self.__dict__['_cert_path'] = path
+        self.__dict__['_blob'] = blob
+        self.__dict__['_cert'] = None
+        # attributes set before the certificate was loaded
+        self.__dict__['_set'] = {}
+
+    @property
+    def __class__(self):
+        cert_class = self.__dict__.get('_cert_class')
+        if cert_class is None:
+            cert_class = self._load().__class__
+        return cert_class
+
+    def _load(self):
+        cert = self.__dict__['_cert']
+        if cert is None:
+            path = self.__dict__['_cert_path']
+            try:
+                cert = pickle.loads(self.__dict__['_blob'])
+            except Exception, e:
+                log.debug("Unreadable cached certificate %s, parsing it again: %s" % (path, e))
+                cert = create_from_file(path)
+            for name, value in self.__dict__['_set'].items():
+                setattr(cert, name, value)
+            self.__dict__['_set'] = {}
+            self.__dict__['_cert'] = cert
+            self.__dict__['_blob'] = None
+        return cert
+
+    def key_path(self):
+        try:
+            return self.__dict__['_key_path']
+        except KeyError:
+            return self._load().key_path()
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        if self.__dict__['_cert'] is None:
+            # Applied to the certificate once it is loaded
+            self.__dict__['_set'][name] = value
+            self.__dict__[name] = value
+            return
+        setattr(self.__dict__['_cert'], name, value)
+        self.__dict__.pop(name, None)
+
+    def __cmp__(self, other):
+        if isinstance(other, LazyCertificate):
+            other = other._load()
+        return cmp(self._load(), other)
+
+    __hash__ = object.__hash__
+
+    def __reduce_ex__(self, protocol):
+        # Copies and pickles are of the full certificate, __class__ alone
+        # would make them of the certificate class with this proxy's state
+        return self._load().__reduce_ex__(protocol)
+
+    def __str__(self):
+        return str(self._load())
+
+    def __repr__(self):
+        return "<LazyCertificate %s>" % self.__dict__['_cert_path']
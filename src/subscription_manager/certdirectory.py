@@ -15,12 +15,18 @@
 # in this software or its documentation.
 #
 
+import bisect
+from datetime import datetime
 import gettext
 import logging
+import multiprocessing
 import os
+import shutil
+import tempfile
 
-from rhsm.certificate import Key, create_from_file
+from rhsm.certificate import GMT, Key, create_from_file
 from rhsm.config import initConfig
+from subscription_manager.certcache import CertificateCache
 from subscription_manager.injection import require, ENT_DIR
 
 log = logging.getLogger('rhsm-app.' + __name__)
@@ -31,6 +37,40 @@ cfg = initConfig()
 
 DEFAULT_PRODUCT_CERT_DIR = "/etc/pki/product-default"
 
+# Fewer certificates to parse than this are not worth starting processes for.
+PARALLEL_PARSE_MIN = 50
+
+
+def _parse_workers():
+    """
+    Number of processes to parse certificates with, from the rhsm.conf
+    cert_parse_workers setting. 0 or 1 means parse in this process.
+    """
+    if not cfg.has_option('rhsm', 'cert_parse_workers'):
+        return 0
+    try:
+        return cfg.get_int('rhsm', 'cert_parse_workers') or 0
+    except ValueError:
+        log.warn("Invalid value for rhsm.cert_parse_workers, parsing certificates serially.")
+        return 0
+
+
+def _parse_cert_in_worker(path):
+    cert = create_from_file(path)
+    # The raw X509 object can not be pickled back to the parent process.
+    if hasattr(cert, 'x509'):
+        cert.x509 = None
+    return cert
+
+
+def _parse_certs_in_pool(paths, workers):
+    pool = multiprocessing.Pool(processes=workers)
+    try:
+        return pool.map(_parse_cert_in_worker, paths)
+    finally:
+        pool.terminate()
+        pool.join()
+
 
 class Directory(object):
 
@@ -97,86 +137,322 @@ class Directory(object):
         return self.path
 
 
+class CertificateIndex(object):
+    """
+    Lookup tables by serial, product id and stacking id over a certificate
+    listing, so finding certificates does not require a scan of the listing.
+
+    Lists in the tables keep the order of the listing.
+    """
+
+    def __init__(self, certs):
+        self.certs = certs
+        self.count = len(certs)
+        self._by_serial = None
+        self._by_product = None
+        self._by_stacking_id = None
+        self._validity = None
+
+    # Each table is only built once it is used. The serial table only needs
+    # serials, which lazily loaded certificates know without being decoded.
+    @property
+    def by_serial(self):
+        if self._by_serial is None:
+            self._by_serial = {}
+            for c in self.certs:
+                self._by_serial.setdefault(c.serial, c)
+        return self._by_serial
+
+    @property
+    def by_product(self):
+        if self._by_product is None:
+            self._by_product = {}
+            for c in self.certs:
+                for p in c.products:
+                    self._by_product.setdefault(p.id, []).append(c)
+        return self._by_product
+
+    @property
+    def by_stacking_id(self):
+        if self._by_stacking_id is None:
+            self._by_stacking_id = {}
+            for c in self.certs:
+                if c.order and c.order.stacking_id:
+                    self._by_stacking_id.setdefault(c.order.stacking_id, []).append(c)
+        return self._by_stacking_id
+
+    def covers(self, certs):
+        """ Return True if this index was built from the given listing. """
+        return certs is self.certs and len(certs) == self.count
+
+    @property
+    def validity(self):
+        if self._validity is None:
+            self._validity = DateRangeIndex(self.certs)
+        return self._validity
+
+
+def _to_gmt(date):
+    """
+    Convert date to an aware GMT datetime, naive dates are assumed to
+    already be in GMT and None means now.
+    """
+    if date is None:
+        return datetime.now(GMT())
+    if date.tzinfo is None:
+        return date.replace(tzinfo=GMT())
+    return date.astimezone(GMT())
+
+
+class _IntervalNode(object):
+    """
+    Node of a centered interval tree over (begin, end, position) entries.
+
+    Entries containing the center are kept here, sorted by begin and by
+    end, entries entirely before or after the center go to the left or
+    right subtree.
+    """
+
+    def __init__(self, entries):
+        points = sorted([e[0] for e in entries] + [e[1] for e in entries])
+        self.center = points[len(points) // 2]
+
+        here = []
+        left = []
+        right = []
+        for e in entries:
+            if e[1] < self.center:
+                left.append(e)
+            elif e[0] > self.center:
+                right.append(e)
+            else:
+                here.append(e)
+
+        by_begin = sorted(here, key=lambda e: e[0])
+        self.begins = [e[0] for e in by_begin]
+        self.begin_positions = [e[2] for e in by_begin]
+        by_end = sorted(here, key=lambda e: e[1])
+        self.ends = [e[1] for e in by_end]
+        self.end_positions = [e[2] for e in by_end]
+
+        self.left = left and _IntervalNode(left) or None
+        self.right = right and _IntervalNode(right) or None
+
+
+class DateRangeIndex(object):
+    """
+    Interval index over the valid_range of a list of certificates.
+
+    "Valid on a date" is answered by a centered interval tree, "expired on
+    a date" and "overlaps a range" by bisecting the sorted end and begin
+    dates, so each query is logarithmic plus the size of its result.
+    Results keep the order of the listing.
+    """
+
+    def __init__(self, certs):
+        self.certs = certs
+        entries = [(c.valid_range.begin(), c.valid_range.end(), pos)
+                   for pos, c in enumerate(certs)]
+
+        by_begin = sorted(entries, key=lambda e: e[0])
+        self._begins = [e[0] for e in by_begin]
+        self._begin_positions = [e[2] for e in by_begin]
+        by_end = sorted(entries, key=lambda e: e[1])
+        self._ends = [e[1] for e in by_end]
+        self._end_positions = [e[2] for e in by_end]
+
+        self._tree = entries and _IntervalNode(entries) or None
+
+    def valid_on(self, on_date=None):
+        """ Certificates whose valid range includes on_date (default now). """
+        return self._certs_at(self._stab(_to_gmt(on_date)))
+
+    def expired_on(self, on_date=None):
+        """ Certificates whose valid range ended before on_date (default now). """
+        i = bisect.bisect_left(self._ends, _to_gmt(on_date))
+        return self._certs_at(self._end_positions[:i])
+
+    def overlapping(self, begin, end):
+        """ Certificates whose valid range shares any date with [begin, end]. """
+        begin = _to_gmt(begin)
+        end = _to_gmt(end)
+        # Either the cert is already valid at begin, or it starts during the range.
+        positions = set(self._stab(begin))
+        lo = bisect.bisect_right(self._begins, begin)
+        hi = bisect.bisect_right(self._begins, end)
+        positions.update(self._begin_positions[lo:hi])
+        return self._certs_at(positions)
+
+    def _stab(self, date):
+        positions = []
+        node = self._tree
+        while node is not None:
+            if date < node.center:
+                # Everything here ends after date, so it only has to begin by date.
+                i = bisect.bisect_right(node.begins, date)
+                positions.extend(node.begin_positions[:i])
+                node = node.left
+            elif date > node.center:
+                # Everything here begins before date, so it only has to end after it.
+                i = bisect.bisect_left(node.ends, date)
+                positions.extend(node.end_positions[i:])
+                node = node.right
+            else:
+                positions.extend(node.begin_positions)
+                break
+        return positions
+
+    def _certs_at(self, positions):
+        return [self.certs[pos] for pos in sorted(positions)]
+
+
 class CertificateDirectory(Directory):
 
     KEY = 'key.pem'
 
+    # Built lazily from the listing by _get_index(), dropped on refresh()
+    _index = None
+
+    # See generation(), and the listing and a copy of it it was last taken for
+    _generation = 0
+    _generation_listing = None
+
     def __init__(self, path):
         super(CertificateDirectory, self).__init__(path)
         self.create()
         self._listing = None
+        # filename -> (stat key, certificate) for the last listing
+        self._loaded = {}
+        # names of all files found by the last listing
+        self._filenames = None
+        self.cert_cache = CertificateCache(self.path)
+
+    def refresh(self, full=False):
+        """
+        Mark the listing stale, the next list() will rescan the directory.
 
-    def refresh(self):
-        # simply clear the cache. the next list() will reload.
+        Certificates whose file is unchanged since the last listing are
+        reused, only new or modified files are loaded again and removed
+        files are dropped. Pass full=True to also forget the last listing.
+        """
         self._listing = None
+        self._index = None
+        if full:
+            self._loaded = {}
 
     def list(self):
         if self._listing is not None:
             return self._listing
-        listing = []
+        loaded = {}
+        filenames = set()
+        cert_filenames = []
+        # (filename, path, stat key) of certs that have to be parsed
+        to_parse = []
         for p, fn in Directory.list(self):
+            filenames.add(fn)
             if not fn.endswith('.pem') or fn.endswith(self.KEY):
                 continue
+            cert_filenames.append(fn)
             path = self.abspath(fn)
-            listing.append(create_from_file(path))
-        self._listing = listing
-        return listing
+            stat_key = self.cert_cache.stat_key(path)
+            previous = self._loaded.get(fn)
+            if stat_key is not None and previous is not None and previous[0] == stat_key:
+                cert = previous[1]
+            else:
+                cert = self.cert_cache.get(path, stat_key)
+            if cert is None:
+                to_parse.append((fn, path, stat_key))
+            else:
+                loaded[fn] = (stat_key, cert)
 
-    def list_valid(self):
-        valid = []
-        for c in self.list():
-            if c.is_valid():
-                valid.append(c)
-        return valid
+        parsed = self._parse_certs([path for fn, path, stat_key in to_parse])
+        for (fn, path, stat_key), cert in zip(to_parse, parsed):
+            self.cert_cache.put(path, stat_key, cert)
+            loaded[fn] = (stat_key, cert)
 
-    def list_expired(self):
-        expired = []
-        for c in self.list():
-            if c.is_expired():
-                expired.append(c)
-        return expired
+        self.cert_cache.prune(loaded)
+        self.cert_cache.write()
+        self._loaded = loaded
+        self._filenames = filenames
+        self._listing = [loaded[fn][1] for fn in cert_filenames]
+        return self._listing
+
+    def generation(self):
+        """
+        Return a number that moves whenever the certificates listed in the
+        directory change, so callers can tell whether anything they derived
+        from the listing is outdated without going through it.
+
+        Unchanged certificates are the same objects across refreshes, so
+        a refresh that finds nothing new keeps the generation.
+        """
+        listing = self.list()
+        last = self._generation_listing
+        if last is not None and last[0] is listing and len(last[1]) == len(listing):
+            return self._generation
+
+        if last is None or len(last[1]) != len(listing) or \
+                [cert for cert, last_cert in zip(listing, last[1]) if cert is not last_cert]:
+            self._generation += 1
+        self._generation_listing = (listing, list(listing))
+        return self._generation
+
+    def _parse_certs(self, paths):
+        """
+        Parse the certificates at the given paths. Large batches are spread
+        over a pool of cert_parse_workers processes, if configured.
+        """
+        workers = _parse_workers()
+        if workers > 1 and len(paths) >= PARALLEL_PARSE_MIN:
+            log.debug("Parsing %s certificates with %s processes" % (len(paths), workers))
+            try:
+                return _parse_certs_in_pool(paths, workers)
+            except Exception, e:
+                log.warn("Parallel certificate parsing failed, parsing serially: %s" % e)
+        return [create_from_file(path) for path in paths]
+
+    def list_valid(self, on_date=None):
+        return self.get_date_index().valid_on(on_date)
+
+    def list_expired(self, on_date=None):
+        return self.get_date_index().expired_on(on_date)
 
     def find(self, sn):
-        # TODO: could optimize to just load SERIAL.pem? Maybe not in all cases.
-        for c in self.list():
-            if c.serial == sn:
-                return c
-        return None
+        return self._get_index().by_serial.get(sn)
 
     def find_all_by_product(self, p_hash):
-        certs = set()
-        providing_stack_ids = set()
-        stack_id_map = {}
+        index = self._get_index()
+        certs = set(index.by_product.get(p_hash, []))
 
-        # Note this will override a product cert for id '71' with
-        # a different product cert for id '71' if it is later in self.list
-        for c in self.list():
-            for p in c.products:
-                if p.id == p_hash:
-                    certs.add(c)
-                    # Keep track of stacks that provide our product
-                    if (c.order and c.order.stacking_id):
-                        providing_stack_ids.add(c.order.stacking_id)
-
-            # Keep track of stack ids in case we need them later.  avoids another loop
-            if (c.order and c.order.stacking_id):
-                if c.order.stacking_id not in stack_id_map:
-                    stack_id_map[c.order.stacking_id] = set()
-                stack_id_map[c.order.stacking_id].add(c)
-
-        # Complete
-        for stack_id in providing_stack_ids:
-            certs |= stack_id_map[stack_id]
+        # Complete with all certs stacked with one that provides our product
+        for c in list(certs):
+            if c.order and c.order.stacking_id:
+                certs |= set(index.by_stacking_id[c.order.stacking_id])
 
         return list(certs)
 
     def find_by_product(self, p_hash):
-        for c in self.list():
-            for p in c.products:
-                if p.id == p_hash:
-                    return c
+        certs = self._get_index().by_product.get(p_hash)
+        if certs:
+            return certs[0]
         return None
 
+    def get_date_index(self):
+        """
+        Return the DateRangeIndex over the valid ranges of the current listing.
+        """
+        return self._get_index().validity
+
+    def _get_index(self):
+        """
+        Return the CertificateIndex for the current listing, building it
+        if the listing was (re)loaded since the index was last built.
+        """
+        listing = self.list()
+        if self._index is None or not self._index.covers(listing):
+            self._index = CertificateIndex(listing)
+        return self._index
+
     #Set up an alias for backwards compatibility
     findByProduct = find_by_product
 
@@ -218,6 +494,12 @@ class ProductCertificateDirectory(CertificateDirectory):
 
 
 class ProductDirectory(ProductCertificateDirectory):
+
+    # (installed listing, default listing, merged listing) of the last list()
+    _merged = None
+    # (listing, listing length, installed products) of the last get_installed_products()
+    _installed_products = None
+
     def __init__(self, path=None, default_path=None):
         installed_prod_path = path or cfg.get('rhsm', 'productCertDir')
         default_prod_path = default_path or DEFAULT_PRODUCT_CERT_DIR
@@ -228,14 +510,32 @@ class ProductDirectory(ProductCertificateDirectory):
         installed_prod_list = self.installed_prod_dir.list()
         default_prod_list = self.default_prod_dir.list()
 
-        # Product IDs in installed_prod dir.
-        pids = set([cert.products[0].id for cert in installed_prod_list])
-        # Everything from /etc/pki/product, only use product-default for pids that don't already exist
-        return installed_prod_list + filter(lambda l: l.products[0].id not in pids, default_prod_list)
+        # Both directories hand back the same listing until they are refreshed,
+        # so only merge again when either of them reloaded.
+        if self._merged is None or self._merged[0] is not installed_prod_list or \
+                self._merged[1] is not default_prod_list:
+            # Product IDs in installed_prod dir.
+            pids = set([cert.products[0].id for cert in installed_prod_list])
+            # Everything from /etc/pki/product, only use product-default for pids that don't already exist
+            merged = installed_prod_list + [cert for cert in default_prod_list
+                                            if cert.products[0].id not in pids]
+            self._merged = (installed_prod_list, default_prod_list, merged)
+        return self._merged[2]
 
-    def refresh(self):
-        self.installed_prod_dir.refresh()
-        self.default_prod_dir.refresh()
+    def get_installed_products(self):
+        listing = self.list()
+        memo = self._installed_products
+        if memo is None or memo[0] is not listing or memo[1] != len(listing):
+            products = super(ProductDirectory, self).get_installed_products()
+            memo = self._installed_products = (listing, len(listing), products)
+        return dict(memo[2])
+
+    def refresh(self, full=False):
+        self.installed_prod_dir.refresh(full=full)
+        self.default_prod_dir.refresh(full=full)
+        self._merged = None
+        self._installed_products = None
+        self._index = None
 
     # In productid.py, ProductDirectory.path is used as path to write new certs
     # to. Souse  the installed_prod_dir (/etc/pki/product) as that is
@@ -273,46 +573,57 @@ class EntitlementDirectory(CertificateDirectory):
         See bz #711133.
         """
         key_path = cert.key_path()
-        if not os.access(key_path, os.R_OK):
+        if not self._is_readable(key_path):
             # read key from old key path
             old_key_path = "%s/key.pem" % self.path
 
             # if we don't have a new style or old style key, consider the
             # cert invalid
-            if not os.access(old_key_path, os.R_OK):
+            if not self._is_readable(old_key_path):
                 return False
 
             # write the key/cert out again in new style format
             key = Key.read(old_key_path)
-            cert_writer = Writer(self)
+            cert_writer = Writer()
             cert_writer.write(key, cert)
+            if self._filenames is not None:
+                self._filenames.add(os.path.basename(key_path))
         return True
 
-    def list_valid(self):
-        valid = []
+    def _is_readable(self, path):
+        """
+        Check if we can read path. For root, files directly in this
+        directory are looked up in the file names found by the last list()
+        rather than probed on disk, as root can read any of them. Other
+        users may not be able to read a listed file, so they still probe
+        every path with os.access().
+        """
+        if self._filenames is None or os.geteuid() != 0 or \
+                os.path.dirname(path) != os.path.normpath(self.path):
+            return os.access(path, os.R_OK)
+        return os.path.basename(path) in self._filenames
+
+    def list_valid(self, on_date=None):
+        # Check the key of every certificate, not only the valid ones, so
+        # old style key.pem files are also migrated for expired and future
+        # dated certificates.
+        missing_key = set()
         for c in self.list():
 
             # If something is amiss with the key for this certificate, consider
             # it invalid:
             if not self._check_key(c):
-                continue
-
-            if c.is_valid():
-                valid.append(c)
+                missing_key.add(id(c))
 
-        return valid
+        return [c for c in super(EntitlementDirectory, self).list_valid(on_date)
+                if id(c) not in missing_key]
 
     def list_for_product(self, product_id):
         """
         Returns all entitlement certificates providing access to the given
         product ID.
         """
-        entitlements = []
-        for cert in self.list():
-            for cert_product in cert.products:
-                if product_id == cert_product.id:
-                    entitlements.append(cert)
-        return entitlements
+        return list(self._get_index().by_product.get(product_id, []))
 
 
 class Path:
@@ -345,13 +656,50 @@ class Writer:
         self.ent_dir = require(ENT_DIR)
 
     def write(self, key, cert):
-        serial = cert.serial
-        ent_dir_path = self.ent_dir.productpath()
+        self.write_all([(key, cert)])
 
-        key_filename = '%s-key.pem' % str(serial)
-        key_path = Path.join(ent_dir_path, key_filename)
-        key.write(key_path)
+    def write_all(self, key_cert_pairs):
+        """
+        Install a batch of entitlement (key, cert) pairs.
+
+        Everything is first written and fsync'ed in a staging directory
+        inside the entitlement directory, then renamed into place key
+        before cert, and the directory is fsync'ed once. Readers never see
+        a partially written file or a cert without its key, even after a
+        crash.
 
-        cert_filename = '%s.pem' % str(serial)
-        cert_path = Path.join(ent_dir_path, cert_filename)
-        cert.write(cert_path)
+        If writing any pair to the staging directory fails nothing is
+        installed. A rename that fails leaves the pairs renamed before it
+        installed, and possibly the key of its own pair without the cert.
+        """
+        ent_dir_path = Path.abs(self.ent_dir.productpath())
+        staging_path = tempfile.mkdtemp(prefix='.staging-', dir=ent_dir_path)
+        try:
+            renames = []
+            for key, cert in key_cert_pairs:
+                serial = str(cert.serial)
+                for item, filename in ((key, '%s-key.pem' % serial),
+                                       (cert, '%s.pem' % serial)):
+                    staged = os.path.join(staging_path, filename)
+                    item.write(staged)
+                    _fsync(staged)
+                    renames.append((staged, os.path.join(ent_dir_path, filename)))
+
+            for staged, final in renames:
+                os.rename(staged, final)
+
+            for key, cert in key_cert_pairs:
+                key.path = os.path.join(ent_dir_path, '%s-key.pem' % str(cert.serial))
+                cert.path = os.path.join(ent_dir_path, '%s.pem' % str(cert.serial))
+            _fsync(ent_dir_path)
+        finally:
+            shutil.rmtree(staging_path, ignore_errors=True)
+
+
+def _fsync(path):
+    """ Flush a file, or the entries of a directory, to disk. """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -90,18 +90,19 @@ class ContentActionClient(base_action_client.BaseActionClient):
         for each plugin hook mapped to the 'update_content_hook' slot.
         """
 
-        yield repolib.RepoActionInvoker()
+        # Ent dir is our only source of entitlement/content info atm
+        # NOTE: this is created and populated with the content of
+        # the ent dir before the yum repos are updated and the plugins
+        # are run, and it doesn't update. Sharing it means its content
+        # index is only built once.
+        ent_dir_ent_source = EntitlementDirEntitlementSource()
+
+        yield repolib.RepoActionInvoker(ent_source=ent_dir_ent_source)
 
         plugin_manager = inj.require(inj.PLUGIN_MANAGER)
 
         content_plugins_reports = ContentPluginActionReport()
 
-        # Ent dir is our only source of entitlement/content info atm
-        # NOTE: this is created and populated with the content of
-        # the ent dir before the plugins are run and it doesn't
-        # update.
-        ent_dir_ent_source = EntitlementDirEntitlementSource()
-
         for runner in plugin_manager.runiter('update_content',
                                              reports=content_plugins_reports,
                                              ent_source=ent_dir_ent_source):
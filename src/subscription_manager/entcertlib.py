@@ -289,8 +289,7 @@ class EntitlementCertBundlesInstaller(object):
     def install(self, cert_bundles):
         """Fetch entitliement certs, install them, and update the report."""
         bundle_installer = EntitlementCertBundleInstaller(self.report)
-        for cert_bundle in cert_bundles:
-            bundle_installer.install(cert_bundle)
+        bundle_installer.install_all(cert_bundles)
         self.exceptions = bundle_installer.exceptions
         self.post_install()
 
@@ -317,7 +316,8 @@ class EntitlementCertBundleInstaller(object):
     """Install an entitlement cert bundle (cert/key).
 
     Split a bundle into an certificate.EntitlementCertificate and a
-    certificate.Key, and persist them.
+    certificate.Key, and persist them. install_all() does the same for a
+    list of bundles, writing them to disk in a single batch.
 
     pre_install() is called before the cert bundle is installed.
     post_install() is called after the cert bundle is installed.
@@ -332,18 +332,37 @@ class EntitlementCertBundleInstaller(object):
 
     def install(self, bundle):
         """Persist an ent cert and it's key after splitting it from the bundle."""
-        self.pre_install(bundle)
-
-        cert_bundle_writer = Writer()
-        try:
-            key, cert = self.build_cert(bundle)
-            cert_bundle_writer.write(key, cert)
-
-            self.report.added.append(cert)
-        except Exception, e:
-            self.install_exception(bundle, e)
+        self.install_all([bundle])
+
+    def install_all(self, bundles):
+        """Persist the ent certs and keys of several bundles in one batch.
+
+        Bundles that can not be split are skipped, the rest are written
+        together by Writer.write_all(). pre_install() is called for every
+        bundle before any of them is written, and post_install() for every
+        bundle once they all are, not around each bundle as install() used
+        to.
+        """
+        built = []
+        for bundle in bundles:
+            self.pre_install(bundle)
+            try:
+                built.append((bundle, self.build_cert(bundle)))
+            except Exception, e:
+                self.install_exception(bundle, e)
 
-        self.post_install(bundle)
+        if built:
+            cert_bundle_writer = Writer()
+            try:
+                cert_bundle_writer.write_all([key_cert for bundle, key_cert in built])
+                for bundle, (key, cert) in built:
+                    self.report.added.append(cert)
+            except Exception, e:
+                for bundle, key_cert in built:
+                    self.install_exception(bundle, e)
+
+        for bundle in bundles:
+            self.post_install(bundle)
 
     # TODO: add subman plugin, slot, and conduit
     def pre_install(self, bundle):
@@ -14,8 +14,10 @@
 from datetime import datetime
 import gettext
 import glob
+import hashlib
 import logging
 import os
+import time
 
 import rhsm.config
 
@@ -32,6 +34,90 @@ log = logging.getLogger('rhsm-app.' + __name__)
 # prefers:
 CERT_VERSION = "3.2"
 
+cfg = rhsm.config.initConfig()
+
+
+def _excluded_interfaces():
+    """
+    Glob patterns of network interface names to leave out of the facts,
+    from the rhsm.conf exclude_network_interfaces setting.
+    """
+    if not cfg.has_option('rhsm', 'exclude_network_interfaces'):
+        return []
+    return cfg.get('rhsm', 'exclude_network_interfaces').replace(',', ' ').split()
+
+
+class FactCollectorCache(object):
+    """
+    Facts found by hardware collectors on earlier runs.
+
+    Only collectors with an input stamp, see Hardware.collector_inputs(),
+    are cached. Their facts are reused while the stamp is the same (so cpu
+    and DMI facts until a reboot or cpu hotplug) and for at most the TTL
+    of the collector.
+    """
+    CACHE_FILE = "/var/lib/rhsm/facts/collectors.json"
+
+    # collector name -> rhsm.conf option for its TTL in seconds
+    TTL_OPTIONS = {'release': 'release_facts_cache_ttl',
+                   'cpu': 'cpu_facts_cache_ttl',
+                   'lscpu': 'cpu_facts_cache_ttl',
+                   'platform': 'dmi_facts_cache_ttl',
+                   'virt': 'virt_facts_cache_ttl'}
+    DEFAULT_TTL = 86400
+
+    def __init__(self, store):
+        self.store = store
+        # collector name -> [stamp, time written, facts]
+        self._entries = None
+        self._dirty = False
+
+    def get(self, name, stamp):
+        """ Return the cached facts of collector name, or None. """
+        ttl = self._get_ttl(name)
+        if stamp is None or ttl <= 0:
+            return None
+        entry = self._get_entries().get(name)
+        if entry is None:
+            return None
+        cached_stamp, written, facts = entry
+        if cached_stamp != stamp or not 0 <= time.time() - written < ttl:
+            return None
+        return facts
+
+    def put(self, name, stamp, facts):
+        if stamp is None or facts is None or self._get_ttl(name) <= 0:
+            return
+        self._get_entries()[name] = [stamp, time.time(), facts]
+        self._dirty = True
+
+    def write(self):
+        if self._dirty:
+            self.store.put(self.CACHE_FILE, json.dumps(self._entries, default=json.encode))
+            self._dirty = False
+
+    def _get_entries(self):
+        if self._entries is None:
+            self._entries = {}
+            data = self.store.get(self.CACHE_FILE)
+            if data is not None:
+                try:
+                    self._entries = json.loads(data)
+                except ValueError:
+                    log.debug("Ignoring unreadable cache: %s" % self.CACHE_FILE)
+        return self._entries
+
+    def _get_ttl(self, name):
+        option = self.TTL_OPTIONS.get(name)
+        if option is None:
+            return 0
+        if cfg.has_option('rhsm', option):
+            try:
+                return cfg.get_int('rhsm', option) or 0
+            except ValueError:
+                log.warn("Invalid value for rhsm.%s, using %s." % (option, self.DEFAULT_TTL))
+        return self.DEFAULT_TTL
+
 
 class Facts(CacheManager):
     """
@@ -40,9 +126,20 @@ class Facts(CacheManager):
 
     Includes both those hard coded in the app itself, as well as custom
     facts to be loaded from /etc/rhsm/facts/.
+
+    Along with the cached facts, the digest of the facts each source
+    (hardware collector or the custom facts) found is kept, with a stamp
+    of the inputs of the source where it has cheap ones. has_changed()
+    only runs the sources whose stamp moved, and compares their digests.
+    The names of the facts each hardware collector found are kept too, so
+    the cached facts of a collector that times out can stand in for it.
     """
     CACHE_FILE = "/var/lib/rhsm/facts/facts.json"
 
+    # Fact source name -> [input stamp, digest, fact names] of the cached
+    # facts, no fact names for the custom facts
+    SOURCE_STATE = "/var/lib/rhsm/facts/sources"
+
     def __init__(self, ent_dir=None, prod_dir=None):
         self.facts = {}
 
@@ -55,12 +152,16 @@ class Facts(CacheManager):
         # that we need to update
         self.graylist = ['cpu.cpu_mhz', 'lscpu.cpu_mhz']
 
+        # Source state of the facts last collected, None when unknown
+        self._hw_source_state = None
+        self._source_state = None
+
         # plugin manager so we can add custom facst via plugin
         self.plugin_manager = require(PLUGIN_MANAGER)
 
     def get_last_update(self):
         try:
-            return datetime.fromtimestamp(os.stat(self.CACHE_FILE).st_mtime)
+            return datetime.fromtimestamp(self._cache_mtime())
         except Exception:
             return None
 
@@ -73,6 +174,10 @@ class Facts(CacheManager):
             log.debug("Cache %s does not exit" % self.CACHE_FILE)
             return True
 
+        if self._sources_unchanged():
+            log.debug("No fact source changed since %s was cached" % self.CACHE_FILE)
+            return False
+
         cached_facts = self._read_cache() or {}
         # In order to accurately check for changes, we must refresh local data
         self.facts = self.get_facts(True)
@@ -82,15 +187,99 @@ class Facts(CacheManager):
                 return True
         return False
 
+    def _sources_unchanged(self):
+        """
+        Check the fact sources against the digests stored with the cache.
+        Sources whose input stamp did not change are not run at all, the
+        others are run with the timeouts of a full collection and their
+        facts compared by digest.
+
+        False means the full set of facts has to be compared, which is
+        also the answer when a source could not be checked.
+        """
+        data = self._get_store().get(self.SOURCE_STATE)
+        if data is None:
+            return False
+        try:
+            cached_state = json.loads(data)
+        except ValueError:
+            log.debug("Ignoring unreadable cache: %s" % self.SOURCE_STATE)
+            return False
+
+        # Plugins may change any fact, only the full facts tell
+        if self.plugin_manager.has_hooks('post_facts_collection'):
+            return False
+
+        cached_custom = cached_state.get('custom')
+        if cached_custom is None or \
+                self._facts_digest(self._load_custom_facts()) != cached_custom[1]:
+            log.debug("Custom facts have changed")
+            return False
+
+        try:
+            return self._hw_sources_unchanged(cached_state)
+        except Exception, e:
+            log.debug("Unable to check the hardware fact sources: %s" % e)
+            return False
+
+    def _hw_sources_unchanged(self, cached_state):
+        import hwprobe
+        hw = hwprobe.Hardware(exclude_interfaces=_excluded_interfaces())
+        sources = [name for name, method_name in hw.COLLECTORS]
+        if 'virt_uuid' in cached_state:
+            sources.append('virt_uuid')
+        if set(sources + ['custom']) != set(cached_state):
+            return False
+
+        unstamped = []
+        for name in sources:
+            stamp = hw.collector_inputs(name)
+            if stamp is None:
+                unstamped.append(name)
+            elif stamp != cached_state[name][0]:
+                # Stable sources are only ever reused, if their inputs
+                # changed so did the system.
+                return False
+
+        # virt.uuid is worked out from the facts of other collectors
+        if 'virt_uuid' in unstamped:
+            return False
+
+        timed_out = hw.run_collectors(unstamped)
+        if timed_out:
+            log.debug("Hardware detection of %s facts timed out" % ", ".join(timed_out))
+            return False
+        for name in unstamped:
+            if self._facts_digest(hw.collector_facts.get(name)) != cached_state[name][1]:
+                log.debug("Facts from %s have changed" % name)
+                return False
+        return True
+
+    def _facts_digest(self, facts):
+        if facts is None:
+            return None
+        facts = dict((key, value) for key, value in facts.items()
+                     if key not in self.graylist)
+        return hashlib.sha256(json.dumps(facts, sort_keys=True,
+                                         default=json.encode)).hexdigest()
+
     def get_facts(self, refresh=False):
         if ((len(self.facts) == 0) or refresh):
             facts = {}
+            self._hw_source_state = None
             facts.update(self._load_hw_facts())
 
             # Set the preferred entitlement certificate version:
             facts.update({"system.certificate_version": CERT_VERSION})
 
-            facts.update(self._load_custom_facts())
+            custom_facts = self._load_custom_facts()
+            facts.update(custom_facts)
+
+            self._source_state = None
+            if self._hw_source_state is not None:
+                self._source_state = dict(self._hw_source_state)
+                self._source_state['custom'] = [None, self._facts_digest(custom_facts)]
+
             self.plugin_manager.run('post_facts_collection', facts=facts)
             self.facts = facts
         return self.facts
@@ -100,7 +289,59 @@ class Facts(CacheManager):
 
     def _load_hw_facts(self):
         import hwprobe
-        return hwprobe.Hardware().get_all()
+        collector_cache = FactCollectorCache(self._get_store())
+        hw = hwprobe.Hardware(collector_cache=collector_cache,
+                              exclude_interfaces=_excluded_interfaces())
+        hw_facts = hw.get_all()
+        collector_cache.write()
+
+        # Keep the cached facts for what the timed out collectors would
+        # have found, a missing virt.is_guest would make a guest look like
+        # a physical system.
+        restored = {}
+        if hw.timed_out:
+            log.info("Using cached facts in place of those that timed out")
+            restored = self._cached_collector_facts(hw.timed_out)
+            for found in restored.values():
+                for key, value in found.items():
+                    hw_facts.setdefault(key, value)
+
+        self._hw_source_state = {}
+        for name in set(hw.collector_facts) | set(restored):
+            if name in restored:
+                # No stamp or digest, the next check runs it again
+                self._hw_source_state[name] = [None, None, sorted(restored[name])]
+            else:
+                found = hw.collector_facts[name]
+                self._hw_source_state[name] = [hw.collector_stamps.get(name),
+                                               self._facts_digest(found),
+                                               sorted(found or {})]
+        return hw_facts
+
+    def _cached_collector_facts(self, names):
+        """
+        Return the cached facts of the named hardware collectors, as a
+        dict of collector name -> facts.
+        """
+        # virt.uuid is only worked out with the virt facts
+        if 'virt' in names:
+            names = list(names) + ['virt_uuid']
+
+        cached_facts = self._read_cache() or {}
+        try:
+            cached_state = json.loads(self._get_store().get(self.SOURCE_STATE) or '{}')
+        except ValueError:
+            log.debug("Ignoring unreadable cache: %s" % self.SOURCE_STATE)
+            cached_state = {}
+
+        restored = {}
+        for name in names:
+            state = cached_state.get(name) or []
+            if len(state) < 3:
+                continue
+            restored[name] = dict((key, cached_facts[key]) for key in state[2]
+                                  if key in cached_facts)
+        return restored
 
     def _parse_facts_json(self, json_buffer, file_path):
         custom_facts = None
@@ -156,3 +397,24 @@ class Facts(CacheManager):
     def _load_data(self, open_file):
         json_str = open_file.read()
         return json.loads(json_str)
+
+    def _store_items(self):
+        items = super(Facts, self)._store_items()
+        if self._source_state is not None:
+            items[self.SOURCE_STATE] = json.dumps(self._source_state)
+        return items
+
+    def write_cache(self, debug=True):
+        # to_dict() collects the facts, if needed, before the source state is checked
+        items = self._recorded_store_items()
+        if self.SOURCE_STATE not in items:
+            self._get_store().delete(self.SOURCE_STATE)
+        self._get_store().put_many(items)
+        self._remove_legacy_cache_file()
+        if debug:
+            log.debug("Wrote cache: %s" % self.CACHE_FILE)
+
+    @classmethod
+    def delete_cache(cls):
+        super(Facts, cls).delete_cache()
+        cls._get_store().delete(cls.SOURCE_STATE)
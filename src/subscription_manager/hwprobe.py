@@ -17,16 +17,18 @@
 # in this software or its documentation.
 #
 
-import commands
 import ethtool
+import fnmatch
 import gettext
 import logging
 import os
 import platform
 import re
 import socket
-from subprocess import PIPE, Popen
+from subprocess import PIPE, Popen, STDOUT
 import sys
+import threading
+import time
 
 _ = gettext.gettext
 
@@ -91,6 +93,65 @@ def gather_entries(entries_string):
     return entries
 
 
+# the number of entries in a siblings list, without enumerating them
+def count_entries(entries_string):
+    count = 0
+    for entry_part in entries_string.split(','):
+        range_list = entry_part.split('-')
+        count += int(range_list[-1]) - int(range_list[0]) + 1
+    return count
+
+
+# the facts in the output of the lscpu command
+def parse_lscpu_output(output):
+    lscpuinfo = {}
+    for info in output.split('\n'):
+        try:
+            key, value = info.split(":")
+            nkey = '.'.join(["lscpu", key.lower().strip().replace(" ", "_")])
+            lscpuinfo[nkey] = "%s" % value.strip()
+        except ValueError:
+            # sometimes lscpu outputs weird things. Or fails.
+            pass
+    return lscpuinfo
+
+
+# the reverse of gather_entries, [0, 1, 2, 5] returns "0-2,5"
+def format_entries(entries):
+    ranges = []
+    for entry in sorted(entries):
+        if ranges and ranges[-1][1] == entry - 1:
+            ranges[-1][1] = entry
+        else:
+            ranges.append([entry, entry])
+    return ','.join([start == end and str(start) or "%s-%s" % (start, end)
+                     for start, end in ranges])
+
+
+# /proc/cpuinfo fields lscpu reports, and the lscpu fact they become
+LSCPU_CPUINFO_FIELDS = [('vendor_id', 'lscpu.vendor_id'),
+                        ('cpu family', 'lscpu.cpu_family'),
+                        ('model', 'lscpu.model'),
+                        ('model name', 'lscpu.model_name'),
+                        ('stepping', 'lscpu.stepping'),
+                        ('cpu mhz', 'lscpu.cpu_mhz'),
+                        ('bogomips', 'lscpu.bogomips'),
+                        ('bogomips per cpu', 'lscpu.bogomips'),
+                        ('flags', 'lscpu.flags')]
+
+# cpufreq files of a cpu, and the lscpu fact they become
+LSCPU_CPUFREQ_FILES = [('cpuinfo_max_freq', 'lscpu.cpu_max_mhz'),
+                       ('cpuinfo_min_freq', 'lscpu.cpu_min_mhz')]
+
+# cpu flag -> lscpu.virtualization
+LSCPU_VIRT_FLAGS = [('vmx', 'VT-x'), ('svm', 'AMD-V')]
+
+X86_ARCHES = ['i386', 'i486', 'i586', 'i686', 'x86_64']
+
+# cpuN entries of /sys/devices/system/cpu, which also has cpufreq, etc
+CPU_DIR_RE = re.compile(r'cpu([0-9]+)$')
+
+
 class GenericPlatformSpecificInfoProvider(object):
     """Default provider for platform without a specific platform info provider.
 
@@ -103,9 +164,82 @@ class GenericPlatformSpecificInfoProvider(object):
         pass
 
 
+# Files get_distribution() reads the release from
+RELEASE_FILES = ['/etc/os-release', '/etc/redhat-release']
+
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+
+# Files describing which cpus there are, cpu hotplug changes them
+CPU_LIST_FILES = ['online', 'present', 'possible']
+
+# Hardware collectors get_all() runs at the same time, at most
+COLLECTOR_THREADS = 4
+
+# Seconds a collector may run before get_all() gives up on its facts,
+# and collectors that wait on DNS and get less.
+COLLECTOR_TIMEOUT = 30
+COLLECTOR_TIMEOUTS = {'network': 10}
+
+# Collectors that use the facts of all others, run once those are done
+LAST_COLLECTORS = ['platform']
+
+# Held while a collector starts a command. Popen of python 2 is not
+# thread safe, a child started at the same time as another can inherit
+# and hold open the pipes of the other.
+_popen_lock = threading.Lock()
+
+
+class _DeferredLogRecords(logging.Filter):
+    """
+    Holds back what the collector threads log, for flush() to log from
+    the thread that waits on them. Logging from other threads can
+    deadlock (BZ 988861, 988430).
+    """
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.threads = set()
+        self.records = []
+
+    def filter(self, record):
+        if threading.currentThread() in self.threads:
+            self.records.append(record)
+            return False
+        return True
+
+    def flush(self):
+        # a thread that is done has nothing more to log, what timed out
+        # collectors log later is logged by the next flush
+        self.threads = set([thread for thread in self.threads
+                            if thread.isAlive()])
+        records, self.records = self.records, []
+        for record in records:
+            logging.getLogger(record.name).callHandlers(record)
+
+
+_collector_log = _DeferredLogRecords()
+log.addFilter(_collector_log)
+logging.getLogger('rhsm-app.subscription_manager.dmiinfo').addFilter(_collector_log)
+
+
 class Hardware:
 
-    def __init__(self, prefix=None, testing=None):
+    # Name of each hardware collector and its method, in the order
+    # get_all() runs them.
+    COLLECTORS = [('uname', 'get_uname_info'),
+                  ('release', 'get_release_info'),
+                  ('mem', 'get_mem_info'),
+                  ('cpu', 'get_cpu_info'),
+                  ('lscpu', 'get_ls_cpu_info'),
+                  ('network', 'get_network_info'),
+                  ('network_interfaces', 'get_network_interfaces'),
+                  ('virt', 'get_virt_info'),
+                  # this has to happen after everything else, since
+                  # it expects to check virt and processor info
+                  ('platform', 'get_platform_specific_info')]
+
+    def __init__(self, prefix=None, testing=None, collector_cache=None,
+                 exclude_interfaces=None):
         self.allhw = {}
         # prefix to look for /sys, for testing
         self.prefix = prefix or ''
@@ -118,6 +252,31 @@ class Hardware:
 
         self.platform_specific_info_provider = self.get_platform_specific_info_provider()
 
+        # collector name -> facts it found, or None if it failed, and the
+        # collector_inputs() stamp taken before it ran
+        self.collector_facts = {}
+        self.collector_stamps = {}
+        # names of the collectors the last get_all() gave up on
+        self.timed_out = []
+        # names of the collectors that only found stand-in facts for what
+        # they failed to detect, these are never cached or reused
+        self.degraded = set()
+
+        # facts of collectors from earlier runs, reused while the inputs
+        # of a collector are the same, see facts.FactCollectorCache
+        self.collector_cache = collector_cache
+
+        # see _sys_cpu_numbers()
+        self._sys_cpus = None
+        self._sys_cpus_lock = threading.Lock()
+
+        # glob patterns of network interface names to leave out of the
+        # facts, such as the veth* devices of containers
+        self._exclude_interfaces_re = None
+        if exclude_interfaces:
+            self._exclude_interfaces_re = re.compile(
+                '|'.join([fnmatch.translate(pattern) for pattern in exclude_interfaces]))
+
     def get_uname_info(self):
 
         uname_data = os.uname()
@@ -190,6 +349,7 @@ class Hardware:
             platform_info = self.platform_specific_info_provider(self.allhw).info
 
         self.allhw.update(platform_info)
+        return platform_info
 
     # this version os very RHEL/Fedora specific...
     def get_distribution(self):
@@ -290,8 +450,7 @@ class Hardware:
         # test data
 
         if len(entries):
-            cpumask_entries = gather_entries(entries)
-            return len(cpumask_entries)
+            return count_entries(entries)
         # that field was empty
         return None
 
@@ -388,32 +547,50 @@ class Hardware:
     def check_for_cpu_topo(self, cpu_topo_dir):
         return os.access(cpu_topo_dir, os.R_OK)
 
+    def _sys_cpu_numbers(self):
+        """
+        Return the numbers of the cpuN entries in /sys/devices/system/cpu,
+        sorted. The directory is only listed once, get_cpu_info() and
+        get_ls_cpu_info() both use it and can run at the same time.
+        """
+        self._sys_cpus_lock.acquire()
+        try:
+            if self._sys_cpus is None:
+                cpus = []
+                for cpu in os.listdir(self.prefix + "/sys/devices/system/cpu/"):
+                    match = CPU_DIR_RE.match(cpu)
+                    if match:
+                        cpus.append(int(match.group(1)))
+                cpus.sort()
+                self._sys_cpus = cpus
+            return self._sys_cpus
+        finally:
+            self._sys_cpus_lock.release()
+
     def get_cpu_info(self):
         self.cpuinfo = {}
-        # we also have cpufreq, etc in this dir, so match just the numbs
-        cpu_re = r'cpu([0-9]+$)'
 
         cpu_files = []
         sys_cpu_path = self.prefix + "/sys/devices/system/cpu/"
-        for cpu in os.listdir(sys_cpu_path):
-            if re.match(cpu_re, cpu):
-                cpu_topo_dir = os.path.join(sys_cpu_path, cpu, "topology")
-
-                # see rhbz#1070908
-                # ppc64 machines running on LPARs will add
-                # a sys cpu entry for every cpu thread on the
-                # physical machine, regardless of how many are
-                # allocated to the LPAR. This throws off the cpu
-                # thread count, which throws off the cpu socket count.
-                # The entries for the unallocated or offline cpus
-                # do not have topology info however.
-                # So, skip sys cpu entries without topology info.
-                #
-                # NOTE: this assumes RHEL6+, prior to rhel5, on
-                # some arches like ppc and s390, there is no topology
-                # info ever, so this will break.
-                if self.check_for_cpu_topo(cpu_topo_dir):
-                    cpu_files.append("%s/%s" % (sys_cpu_path, cpu))
+        for cpu_number in self._sys_cpu_numbers():
+            cpu_file = "%scpu%s" % (sys_cpu_path, cpu_number)
+            cpu_topo_dir = cpu_file + "/topology"
+
+            # see rhbz#1070908
+            # ppc64 machines running on LPARs will add
+            # a sys cpu entry for every cpu thread on the
+            # physical machine, regardless of how many are
+            # allocated to the LPAR. This throws off the cpu
+            # thread count, which throws off the cpu socket count.
+            # The entries for the unallocated or offline cpus
+            # do not have topology info however.
+            # So, skip sys cpu entries without topology info.
+            #
+            # NOTE: this assumes RHEL6+, prior to rhel5, on
+            # some arches like ppc and s390, there is no topology
+            # info ever, so this will break.
+            if self.check_for_cpu_topo(cpu_topo_dir):
+                cpu_files.append(cpu_file)
 
         # for systems with no cpus
         if not cpu_files:
@@ -555,36 +732,194 @@ class Hardware:
         self.allhw.update(self.cpuinfo)
         return self.cpuinfo
 
+    def _read_sys_file(self, path):
+        """ Return the stripped contents of path under prefix, or None. """
+        try:
+            f = open(self.prefix + path, 'r')
+        except IOError:
+            return None
+        try:
+            return f.read().rstrip('\n\x00').strip()
+        finally:
+            f.close()
+
+    def _read_cpuinfo(self):
+        """
+        Return the fields of the first processor in /proc/cpuinfo, and the
+        fields before it on s390x, with lower case names.
+        """
+        cpuinfo = {}
+        content = self._read_sys_file('/proc/cpuinfo') or ''
+        for line in content.split('\n'):
+            if not line.strip():
+                if 'processor' in cpuinfo:
+                    break
+                continue
+            key, sep, value = line.partition(':')
+            key = key.strip().lower()
+            if sep and key not in cpuinfo:
+                cpuinfo[key] = value.strip()
+        return cpuinfo
+
     def get_ls_cpu_info(self):
-        # if we have `lscpu`, let's use it for facts as well, under
-        # the `lscpu` name space
-        if not os.access('/usr/bin/lscpu', os.R_OK):
-            return
+        """
+        Collect the facts lscpu reports, under the `lscpu` name space,
+        reading /sys/devices/system/cpu and /proc/cpuinfo as lscpu does
+        instead of running it.
 
+        lscpu finds the hypervisor of a guest with cpuid, and most of what
+        it reports on s390 and ppc in /proc/sysinfo and the device tree, so
+        the facts of the command itself are added on those systems.
+        """
         self.lscpuinfo = {}
-        # let us specify a test dir of /sys info for testing
+        sys_cpu_path = "/sys/devices/system/cpu"
+        if not os.path.isdir(self.prefix + sys_cpu_path):
+            return self.lscpuinfo
+
+        cpuinfo = self._read_cpuinfo()
+        flags = cpuinfo.get('flags', '').split()
+
+        self.lscpuinfo['lscpu.architecture'] = self.arch
+        if 'lm' in flags:
+            self.lscpuinfo['lscpu.cpu_op-mode(s)'] = "32-bit, 64-bit"
+        elif self.arch in X86_ARCHES:
+            self.lscpuinfo['lscpu.cpu_op-mode(s)'] = "32-bit"
+        if sys.byteorder == 'little':
+            self.lscpuinfo['lscpu.byte_order'] = "Little Endian"
+        else:
+            self.lscpuinfo['lscpu.byte_order'] = "Big Endian"
+
+        cpus = self._sys_cpu_numbers()
+        online_list = self._read_sys_file(sys_cpu_path + "/online")
+        online = online_list and gather_entries(online_list) or cpus
+        present_list = self._read_sys_file(sys_cpu_path + "/present")
+        present = present_list and gather_entries(present_list) or cpus
+
+        self.lscpuinfo['lscpu.cpu(s)'] = str(len(present))
+        self.lscpuinfo['lscpu.on-line_cpu(s)_list'] = format_entries(online)
+        offline = set(present) - set(online)
+        if offline:
+            self.lscpuinfo['lscpu.off-line_cpu(s)_list'] = format_entries(offline)
+
+        if online:
+            self._ls_cpu_topology(sys_cpu_path, online)
+            self._ls_cpu_freq("%s/cpu%s/cpufreq" % (sys_cpu_path, online[0]))
+            self._ls_cpu_caches("%s/cpu%s/cache" % (sys_cpu_path, online[0]))
+        self._ls_cpu_numa()
+
+        for field, fact in LSCPU_CPUINFO_FIELDS:
+            if field in cpuinfo:
+                self.lscpuinfo[fact] = cpuinfo[field]
+        for flag, virt_type in LSCPU_VIRT_FLAGS:
+            if flag in flags:
+                self.lscpuinfo['lscpu.virtualization'] = virt_type
+
+        if self.arch not in X86_ARCHES or 'hypervisor' in flags or \
+                os.path.exists(self.prefix + '/proc/xen'):
+            self.lscpuinfo.update(self.run_lscpu())
+
+        self.allhw.update(self.lscpuinfo)
+        return self.lscpuinfo
+
+    def _ls_cpu_topology(self, sys_cpu_path, online):
+        # Same assumption as lscpu, every core and socket looks like the
+        # ones the first online cpu is in.
+        cpu_dir = self.prefix + "%s/cpu%s" % (sys_cpu_path, online[0])
+        threads = self.count_cpumask_entries(cpu_dir, 'thread_siblings_list')
+        core_siblings = self.count_cpumask_entries(cpu_dir, 'core_siblings_list')
+        if not threads or not core_siblings:
+            return
+        cores = core_siblings / threads
+        self.lscpuinfo['lscpu.thread(s)_per_core'] = str(threads)
+        self.lscpuinfo['lscpu.core(s)_per_socket'] = str(cores)
+
+        # lscpu counts the distinct sibling lists, which an offline cpu
+        # does not throw off
+        sockets = self._count_sibling_lists(sys_cpu_path, online, 'core_siblings_list')
+        books = self._count_sibling_lists(sys_cpu_path, online, 'book_siblings_list')
+        if books:
+            self.lscpuinfo['lscpu.socket(s)_per_book'] = str(sockets / books)
+            self.lscpuinfo['lscpu.book(s)'] = str(books)
+        else:
+            self.lscpuinfo['lscpu.socket(s)'] = str(sockets)
+
+    def _count_sibling_lists(self, sys_cpu_path, online, field):
+        """
+        Count the distinct topology sibling lists field of the online cpus,
+        reading the list of one cpu in each. 0 if the first has none.
+        """
+        count = 0
+        counted = set()
+        for cpu in online:
+            if cpu in counted:
+                continue
+            siblings = self._read_sys_file("%s/cpu%s/topology/%s" % (sys_cpu_path, cpu, field))
+            if not siblings and count == 0:
+                return 0
+            count += 1
+            counted.add(cpu)
+            if siblings:
+                counted.update(gather_entries(siblings))
+        return count
+
+    def _ls_cpu_freq(self, cpufreq_path):
+        for name, fact in LSCPU_CPUFREQ_FILES:
+            khz = self._read_sys_file("%s/%s" % (cpufreq_path, name))
+            try:
+                self.lscpuinfo[fact] = "%.4f" % (int(khz) / 1000.0)
+            except (TypeError, ValueError):
+                pass
+
+    def _ls_cpu_caches(self, cache_path):
+        try:
+            indexes = sorted([index for index in os.listdir(self.prefix + cache_path)
+                              if index.startswith('index')])
+        except OSError:
+            return
+        for index in indexes:
+            level = self._read_sys_file("%s/%s/level" % (cache_path, index))
+            cache_type = self._read_sys_file("%s/%s/type" % (cache_path, index))
+            size = self._read_sys_file("%s/%s/size" % (cache_path, index))
+            if not level or not size:
+                continue
+            suffix = {'Data': 'd', 'Instruction': 'i'}.get(cache_type, '')
+            self.lscpuinfo['lscpu.l%s%s_cache' % (level, suffix)] = size
+
+    def _ls_cpu_numa(self):
+        node_path = "/sys/devices/system/node"
+        node_re = re.compile(r'node([0-9]+)$')
+        try:
+            nodes = sorted([int(node_re.match(node).group(1))
+                            for node in os.listdir(self.prefix + node_path)
+                            if node_re.match(node)])
+        except OSError:
+            return
+        if not nodes:
+            return
+        self.lscpuinfo['lscpu.numa_node(s)'] = str(len(nodes))
+        for node in nodes:
+            cpu_list = self._read_sys_file("%s/node%s/cpulist" % (node_path, node))
+            if cpu_list is not None:
+                self.lscpuinfo['lscpu.numa_node%s_cpu(s)' % node] = cpu_list
+
+    def run_lscpu(self):
+        """
+        Return the facts of the lscpu command, for the same prefix in
+        testing mode.
+        """
+        if not os.access('/usr/bin/lscpu', os.R_OK):
+            return {}
         # If the user env sets LC_ALL, it overrides a LANG here, so
         # use LC_ALL here. See rhbz#1225435
-        ls_cpu_path = 'LC_ALL=en_US.UTF-8 /usr/bin/lscpu'
-        ls_cpu_cmd = ls_cpu_path
-
+        ls_cpu_cmd = 'LC_ALL=en_US.UTF-8 /usr/bin/lscpu'
         if self.testing:
             ls_cpu_cmd = "%s -s %s" % (ls_cpu_cmd, self.prefix)
+        _popen_lock.acquire()
         try:
-            cpudata = commands.getstatusoutput(ls_cpu_cmd)[-1].split('\n')
-            for info in cpudata:
-                try:
-                    key, value = info.split(":")
-                    nkey = '.'.join(["lscpu", key.lower().strip().replace(" ", "_")])
-                    self.lscpuinfo[nkey] = "%s" % value.strip()
-                except ValueError:
-                    # sometimes lscpu outputs weird things. Or fails.
-                    #
-                    pass
-        except Exception, e:
-            print _("Error reading system CPU information:"), e
-        self.allhw.update(self.lscpuinfo)
-        return self.lscpuinfo
+            process = Popen(ls_cpu_cmd, shell=True, stdout=PIPE, stderr=STDOUT)
+        finally:
+            _popen_lock.release()
+        return parse_lscpu_output(process.communicate()[0])
 
     def get_network_info(self):
         self.netinfo = {}
@@ -616,13 +951,23 @@ class Hardware:
             return False
         return True
 
+    def _excluded_interface(self, device):
+        return bool(self._exclude_interfaces_re and
+                    self._exclude_interfaces_re.match(device))
+
     def get_network_interfaces(self):
         netinfdict = {}
         old_ipv4_metakeys = ['ipv4_address', 'ipv4_netmask', 'ipv4_broadcast']
         ipv4_metakeys = ['address', 'netmask', 'broadcast']
         ipv6_metakeys = ['address', 'netmask']
+        # master device -> its slaves' permanent hw addresses, so each
+        # /proc/net/bonding file is read once
+        bonding_slaves = {}
         try:
-            interfaces_info = ethtool.get_interfaces_info(ethtool.get_devices())
+            # excluded devices are dropped before ethtool queries any of them
+            devices = [device for device in ethtool.get_devices()
+                       if not self._excluded_interface(device)]
+            interfaces_info = ethtool.get_interfaces_info(devices)
             for info in interfaces_info:
                 master = None
                 mac_address = info.mac_address
@@ -701,7 +1046,9 @@ class Hardware:
 
                 if master:
                     master_interface = os.path.basename(master)
-                    permanent_mac_addr = self._get_slave_hwaddr(master_interface, info.device)
+                    if master_interface not in bonding_slaves:
+                        bonding_slaves[master_interface] = self._get_slave_hwaddrs(master_interface)
+                    permanent_mac_addr = bonding_slaves[master_interface].get(info.device, "")
                     key = '.'.join(['net.interface', info.device, "permanent_mac_address"])
                     netinfdict[key] = permanent_mac_addr
 
@@ -713,25 +1060,29 @@ class Hardware:
     # from rhn-client-tools  hardware.py
     # see bz#785666
     def _get_slave_hwaddr(self, master, slave):
-        hwaddr = ""
+        return self._get_slave_hwaddrs(master).get(slave, "")
+
+    def _get_slave_hwaddrs(self, master):
+        """
+        Return the permanent hw address of every slave of master, by
+        slave interface name, from one read of its /proc/net/bonding file.
+        """
+        hwaddrs = {}
         try:
             bonding = open('/proc/net/bonding/%s' % master, "r")
         except:
-            return hwaddr
+            return hwaddrs
 
-        slave_found = False
+        ifname = None
         for line in bonding.readlines():
-            if slave_found and line.find("Permanent HW addr: ") != -1:
-                hwaddr = line.split()[3].upper()
-                break
+            if ifname and line.find("Permanent HW addr: ") != -1:
+                hwaddrs.setdefault(ifname, line.split()[3].upper())
 
             if line.find("Slave Interface: ") != -1:
                 ifname = line.split()[2]
-                if ifname == slave:
-                    slave_found = True
 
         bonding.close()
-        return hwaddr
+        return hwaddrs
 
     def get_virt_info(self):
         virt_dict = {}
@@ -755,6 +1106,7 @@ class Hardware:
             # Otherwise there was an error running virt-what - who knows
             log.exception(e)
             virt_dict['virt.is_guest'] = 'Unknown'
+            self.degraded.add('virt')
 
         # xen dom0 is a guest for virt-what's purposes, but is a host for
         # our purposes. Adjust is_guest accordingly. (#757697)
@@ -770,7 +1122,11 @@ class Hardware:
 
     def _get_output(self, cmd):
         log.debug("Running '%s'" % cmd)
-        process = Popen([cmd], stdout=PIPE, stderr=PIPE)
+        _popen_lock.acquire()
+        try:
+            process = Popen([cmd], stdout=PIPE, stderr=PIPE)
+        finally:
+            _popen_lock.release()
         (std_output, std_error) = process.communicate()
 
         log.debug("%s stdout: %s" % (cmd, std_output))
@@ -822,38 +1178,203 @@ class Hardware:
         "Log any warnings from firmware info gather,and/or clear them."
         self.get_platform_specific_info_provider().log_warnings()
 
-    def get_all(self):
-        hardware_methods = [self.get_uname_info,
-                            self.get_release_info,
-                            self.get_mem_info,
-                            self.get_cpu_info,
-                            self.get_ls_cpu_info,
-                            self.get_network_info,
-                            self.get_network_interfaces,
-                            self.get_virt_info,
-                            # this has to happen after everything else, since
-                            # it expects to check virt and processor info
-                            self.get_platform_specific_info]
-        # try each hardware method, and try/except around, since
-        # these tend to be fragile
-        for hardware_method in hardware_methods:
+    def run_collector(self, name):
+        """
+        Run the hardware collector name, return the facts it found or None
+        if it failed.
+        """
+        hardware_method = getattr(self, dict(self.COLLECTORS)[name])
+        self.degraded.discard(name)
+        # try/except around each, since these tend to be fragile
+        try:
+            return hardware_method() or {}
+        except Exception, e:
+            log.warn("%s" % hardware_method)
+            log.warn("Hardware detection failed: %s" % e)
+            return None
+
+    def collector_inputs(self, name):
+        """
+        Return a stamp of what the facts of collector name are derived
+        from, or None if there is no cheaper way to tell whether they
+        changed than to run it.
+
+        A collector finds the same facts as long as its stamp is the same.
+        CPU topology, DMI and virt-what results only change across reboots
+        or cpu hotplug, the release with the release files.
+        """
+        if self.testing:
+            return None
+
+        if name == 'release':
+            stats = []
+            for release_file in RELEASE_FILES:
+                try:
+                    st = os.stat(release_file)
+                    stats.append("%s:%s:%s" % (release_file, st.st_size, st.st_mtime))
+                except OSError:
+                    stats.append("%s:-" % release_file)
+            return ";".join(stats)
+
+        if name not in ('cpu', 'lscpu', 'platform', 'virt', 'virt_uuid'):
+            return None
+
+        # DMI info adjusts the cpu facts of xen dom0 hosts
+        if name == 'platform' and \
+                str(self.allhw.get('virt.host_type', '')).find('dom0') > -1:
+            return None
+
+        try:
+            f = open(BOOT_ID_FILE, 'r')
+            boot_id = f.read().strip()
+            f.close()
+        except IOError:
+            return None
+        if not boot_id:
+            return None
+
+        if name in ('cpu', 'lscpu'):
+            cpu_lists = []
+            for cpu_list in CPU_LIST_FILES:
+                try:
+                    f = open("%s/sys/devices/system/cpu/%s" % (self.prefix, cpu_list), 'r')
+                    cpu_lists.append(f.read().strip())
+                    f.close()
+                except IOError:
+                    cpu_lists.append('-')
+            return "%s;%s" % (boot_id, ";".join(cpu_lists))
+        return boot_id
+
+    def _run_collectors(self, names):
+        """
+        Run the named collectors, at most COLLECTOR_THREADS at a time, and
+        wait until each has finished or run out of time. Return the names
+        of those that ran out, their facts are left out.
+
+        A collector that times out can not be stopped, its thread is left
+        to finish on its own and its slot is handed to the next one.
+        """
+        slots = threading.Semaphore(COLLECTOR_THREADS)
+        cond = threading.Condition()
+        # name -> when it got a slot
+        started = {}
+        done = set()
+        timed_out = []
+
+        def run(name):
+            slots.acquire()
+            cond.acquire()
             try:
-                hardware_method()
-            except Exception, e:
-                log.warn("%s" % hardware_method)
-                log.warn("Hardware detection failed: %s" % e)
+                started[name] = time.time()
+                cond.notifyAll()
+            finally:
+                cond.release()
+
+            found = self.run_collector(name)
+
+            cond.acquire()
+            try:
+                # the slot of a timed out collector was already handed on
+                if name not in timed_out:
+                    self.collector_facts[name] = found
+                    done.add(name)
+                    slots.release()
+                    cond.notifyAll()
+            finally:
+                cond.release()
+
+        cached_names = []
+        for name in names:
+            stamp = self.collector_stamps[name] = self.collector_inputs(name)
+            cached = None
+            if self.collector_cache is not None:
+                cached = self.collector_cache.get(name, stamp)
+            if cached is not None:
+                log.debug("Using cached %s facts" % name)
+                self.allhw.update(cached)
+                self.collector_facts[name] = cached
+                cached_names.append(name)
+                done.add(name)
+                continue
+
+            thread = threading.Thread(target=run, args=(name,),
+                                      name="HardwareCollector-%s" % name)
+            thread.setDaemon(True)
+            _collector_log.threads.add(thread)
+            thread.start()
+
+        cond.acquire()
+        try:
+            while True:
+                running = [name for name in started
+                           if name not in done and name not in timed_out]
+                if len(done) + len(timed_out) == len(names):
+                    break
+
+                now = time.time()
+                wait = None
+                for name in running:
+                    left = started[name] + COLLECTOR_TIMEOUTS.get(name, COLLECTOR_TIMEOUT) - now
+                    if left <= 0:
+                        timed_out.append(name)
+                        self.collector_facts[name] = None
+                        slots.release()
+                    elif wait is None or left < wait:
+                        wait = left
+
+                if len(running) == 0 or wait is not None:
+                    # woken up by a collector starting or finishing
+                    cond.wait(wait)
+        finally:
+            cond.release()
+        _collector_log.flush()
+
+        if self.collector_cache is not None:
+            for name in names:
+                if name not in cached_names and name not in self.degraded:
+                    self.collector_cache.put(name, self.collector_stamps[name],
+                                             self.collector_facts.get(name))
+        return timed_out
+
+    def run_collectors(self, names):
+        """
+        Run the named collectors with the timeouts of get_all(), those in
+        LAST_COLLECTORS once the others are done. Return the names of the
+        collectors that timed out.
+        """
+        timed_out = self._run_collectors([name for name in names
+                                          if name not in LAST_COLLECTORS])
+        # this has to happen after everything else, since
+        # it expects to check virt and processor info
+        timed_out += self._run_collectors([name for name in names
+                                           if name in LAST_COLLECTORS])
+        return timed_out
+
+    def get_all(self):
+        self.timed_out = self.run_collectors([name for name, method_name
+                                              in self.COLLECTORS])
+
+        for name in self.timed_out:
+            log.warn("Hardware detection of %s facts timed out" % name)
+        # run failed collectors again next time, whatever their inputs
+        for name, found in self.collector_facts.items():
+            if found is None or name in self.degraded:
+                self.collector_stamps[name] = None
 
         #we need to know the DMI info and VirtInfo before determining UUID.
         #Thus, we can't figure it out within the main data collection loop.
         if self.allhw.get('virt.is_guest'):
+            self.collector_stamps['virt_uuid'] = self.collector_inputs('virt_uuid')
             self.get_virt_uuid()
+            self.collector_facts['virt_uuid'] = {'virt.uuid': self.allhw['virt.uuid']}
 
         log.info("collected virt facts: virt.is_guest=%s, virt.host_type=%s, virt.uuid=%s",
                  self.allhw.get('virt.is_guest', 'Not Set'),
                  self.allhw.get('virt.host_type', 'Not Set'),
                  self.allhw.get('virt.uuid', 'Not Set'))
 
-        return self.allhw
+        # timed out collectors may still add to allhw
+        return dict(self.allhw)
 
 
 if __name__ == '__main__':
@@ -904,6 +1425,17 @@ if __name__ == '__main__':
     must_haves = ['cpu.cpu_socket(s)', 'cpu.cpu(s)', 'cpu.core(s)_per_socket', 'cpu.thread(s)_per_core']
     missing_set = set(must_haves).difference(set(hw_dict))
 
+    # verify the lscpu facts we read ourselves match what lscpu says
+    lscpu_dict = hw.run_lscpu()
+    for lscpu_key in sorted(set(lscpu_dict) & set(hw_dict)):
+        if lscpu_key == 'lscpu.cpu_mhz':
+            continue
+        if hw_dict[lscpu_key] != lscpu_dict[lscpu_key]:
+            failed_list.append((lscpu_key, 'lscpu command', hw_dict[lscpu_key],
+                                lscpu_dict[lscpu_key]))
+    for lscpu_key in sorted(set(lscpu_dict) - set(hw_dict)):
+        print "lscpu fact: %s was not read" % lscpu_key
+
     if failed:
         print "cpu detection error"
     for failed in failed_list:
@@ -19,6 +19,7 @@ from subscription_manager.cache import ProductStatusCache, \
     EntitlementStatusCache, OverrideStatusCache, ProfileManager, \
     InstalledProductsManager, PoolTypeCache, ReleaseStatusCache
 
+from subscription_manager.cachestore import CacheStore
 from subscription_manager.cert_sorter import CertSorter
 from subscription_manager.certdirectory import EntitlementDirectory
 from subscription_manager.certdirectory import ProductDirectory
@@ -47,6 +48,8 @@ def init_dep_injection():
     inj.provide(inj.ENT_DIR, EntitlementDirectory, singleton=True)
     inj.provide(inj.PROD_DIR, ProductDirectory, singleton=True)
 
+    inj.provide(inj.CACHE_STORE, CacheStore, singleton=True)
+
     # FIXME: find a way to handle exceptions when looking for
     #        attributes of inj (can happen if yum has old inj module,
     #        but runs a new version of injectioninit...)
@@ -1354,6 +1354,7 @@ class ReleaseCommand(CliCommand):
         if self.options.unset:
             self.cp.updateConsumer(self.identity.uuid,
                         release="")
+            inj.require(inj.RELEASE_STATUS_CACHE).delete_cache()
             print _("Release preference has been unset")
         elif self.options.release is not None:
             # check first if the server supports releases
@@ -1362,6 +1363,7 @@ class ReleaseCommand(CliCommand):
             if self.options.release in releases:
                 self.cp.updateConsumer(self.identity.uuid,
                         release=self.options.release)
+                inj.require(inj.RELEASE_STATUS_CACHE).delete_cache()
             else:
                 system_exit(os.EX_DATAERR, _("No releases match '%s'.  "
                                  "Consult 'release --list' for a full listing.")
@@ -108,6 +108,8 @@ class PoolFilter(object):
         self.product_directory = product_dir
         self.entitlement_directory = entitlement_dir
         self.sorter = sorter
+        # (startDate, endDate) -> set of entitlement certs valid on either date
+        self._certs_valid_on_pool_dates = {}
 
     def filter_product_ids(self, pools, product_ids):
         """
@@ -204,14 +206,17 @@ class PoolFilter(object):
         return entitled_products_to_certs
 
     def _dates_overlap(self, pool, certs):
-        pool_start = isodate.parse_date(pool['startDate'])
-        pool_end = isodate.parse_date(pool['endDate'])
-
-        for cert in certs:
-            cert_range = cert.valid_range
-            if cert_range.has_date(pool_start) or cert_range.has_date(pool_end):
-                return True
-        return False
+        """
+        Return True if any of the given entitlement certs is valid on the
+        pool's start or end date.
+        """
+        dates = (pool['startDate'], pool['endDate'])
+        if dates not in self._certs_valid_on_pool_dates:
+            date_index = self.entitlement_directory.get_date_index()
+            valid = set(date_index.valid_on(isodate.parse_date(dates[0])))
+            valid.update(date_index.valid_on(isodate.parse_date(dates[1])))
+            self._certs_valid_on_pool_dates[dates] = valid
+        return not self._certs_valid_on_pool_dates[dates].isdisjoint(certs)
 
     def filter_out_overlapping(self, pools):
         entitled_product_ids_to_certs = self._get_entitled_product_to_cert_map()
@@ -59,11 +59,21 @@ class EntitlementSource(object):
     """Populate with info needed for plugins to find content.
 
     Acts as a iterable over entitlements.
+
+    The content of all entitlements is indexed by content type the first
+    time find_content() is used, so repolib and every content plugin
+    sharing an EntitlementSource during a run only walk it once.
     """
     def __init__(self):
         self._entitlements = []
         self.product_tags = []
 
+    # (entitlements, count) the content index was built from, and the
+    # index itself, a dict of lower cased content type to a list of
+    # (content, frozenset of required tags).
+    _content_index_key = None
+    _content_index = None
+
     def __iter__(self):
         return iter(self._entitlements)
 
@@ -73,6 +83,31 @@ class EntitlementSource(object):
     def __getitem__(self, key):
         return self._entitlements[key]
 
+    def _get_content_index(self):
+        # Entitlements may be swapped or appended to after creation
+        key = (self._entitlements, len(self._entitlements))
+        if self._content_index is None or \
+                self._content_index_key[0] is not key[0] or \
+                self._content_index_key[1] != key[1]:
+            index = {}
+            for entitlement in self._entitlements:
+                for content in entitlement.contents:
+                    index.setdefault(content.content_type.lower(), []).append(
+                        (content, frozenset(content.tags)))
+            self._content_index = index
+            self._content_index_key = key
+        return self._content_index
+
+    def find_content(self, content_type=None):
+        """
+        Return a list of model.Content of the given type (compared case
+        insensitive) whose required tags are all provided by product_tags.
+        """
+        product_tags = frozenset(self.product_tags)
+        contents = self._get_content_index().get(content_type.lower(), [])
+        return [content for content, tags in contents
+                if tags <= product_tags]
+
 
 def find_content(ent_source, content_type=None):
     """
@@ -81,8 +116,11 @@ def find_content(ent_source, content_type=None):
 
     Returns a list of model.Content.
     """
-    entitled_content = []
     log.debug("Searching for content of type: %s" % content_type)
+    if isinstance(ent_source, EntitlementSource):
+        return ent_source.find_content(content_type)
+
+    entitled_content = []
     for entitlement in ent_source:
         for content in entitlement.contents:
             # this is basically matching_content from repolib
@@ -97,9 +135,4 @@ def content_tag_match(content_tags, product_tags):
 
     Note: this is skipped if the content does not have any required tags.
     """
-
-    all_tags_found = True
-    for content_tag in content_tags:
-        if content_tag not in product_tags:
-            all_tags_found = False
-    return all_tags_found
+    return set(content_tags).issubset(product_tags)
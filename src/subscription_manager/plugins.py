@@ -788,6 +788,10 @@ class BasePluginManager(object):
             runner = PluginHookRunner(conduit_instance, func)
             yield runner
 
+    def has_hooks(self, slot_name):
+        """Return True if any plugin hook is mapped to slot_name."""
+        return len(self._slot_to_funcs.get(slot_name, [])) > 0
+
     def _get_plugin_config(self, plugin_clazz, plugin_to_config_map=None):
         """Get a PluginConfig for plugin_class, creating it if need be.
 
@@ -45,13 +45,15 @@ _ = gettext.gettext
 
 class RepoActionInvoker(BaseActionInvoker):
     """Invoker for yum repo updating related actions."""
-    def __init__(self, cache_only=False, locker=None):
+    def __init__(self, cache_only=False, locker=None, ent_source=None):
         super(RepoActionInvoker, self).__init__(locker=locker)
         self.cache_only = cache_only
         self.identity = inj.require(inj.IDENTITY)
+        self.ent_source = ent_source
 
     def _do_update(self):
-        action = RepoUpdateActionCommand(cache_only=self.cache_only)
+        action = RepoUpdateActionCommand(cache_only=self.cache_only,
+                                         ent_source=self.ent_source)
         res = action.perform()
         return res
 
@@ -176,14 +178,16 @@ class RepoUpdateActionCommand(object):
 
     Returns an RepoActionReport.
     """
-    def __init__(self, cache_only=False, apply_overrides=True):
+    def __init__(self, cache_only=False, apply_overrides=True, ent_source=None):
         self.identity = inj.require(inj.IDENTITY)
 
         # These should probably move closer their use
         self.ent_dir = inj.require(inj.ENT_DIR)
         self.prod_dir = inj.require(inj.PROD_DIR)
 
-        self.ent_source = ent_cert.EntitlementDirEntitlementSource()
+        # Callers running the content plugins too pass the source they
+        # share, so its content index is only built once.
+        self.ent_source = ent_source or ent_cert.EntitlementDirEntitlementSource()
 
         self.cp_provider = inj.require(inj.CP_PROVIDER)
         self.uep = self.cp_provider.get_consumer_auth_cp()
@@ -0,0 +1,76 @@
+#
+# Copyright (c) 2015 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+"""
+Synthetic sysfs cpu trees of large machines, for test_hw and
+scripts/cpu_info_benchmark.py.
+"""
+
+import os
+
+
+def cpu_mask(cpus, count):
+    """ The kernel's hex mask of cpus, out of count cpus. """
+    mask = sum([1 << cpu for cpu in cpus])
+    return ','.join(['%08x' % ((mask >> shift) & 0xffffffff)
+                     for shift in reversed(range(0, count, 32))])
+
+
+# /proc/cpuinfo entry of each cpu of write_cpu_tree()
+CPU_TREE_CPUINFO = """processor\t: %s
+vendor_id\t: GenuineIntel
+cpu family\t: 6
+model\t\t: 85
+model name\t: Intel(R) Xeon(R) Gold 6130 CPU @ 2.10GHz
+stepping\t: 4
+bogomips\t: 4200.00
+flags\t\t: fpu vme lm
+"""
+
+
+def write_cpu_tree(prefix, cpus, threads_per_core=1, cores_per_socket=1):
+    """
+    Write the sysfs cpu topology and /proc/cpuinfo of cpus cpus, numbered
+    by socket then core then thread, under prefix.
+    """
+    sys_cpu_path = os.path.join(prefix, 'sys/devices/system/cpu')
+    cpus_per_socket = threads_per_core * cores_per_socket
+
+    def write(path, content):
+        f = open(path, 'w')
+        f.write(content + '\n')
+        f.close()
+
+    os.makedirs(sys_cpu_path)
+    write(os.path.join(prefix, 'arch'), 'x86_64')
+    for name in ('online', 'present', 'possible'):
+        write(os.path.join(sys_cpu_path, name), '0-%s' % (cpus - 1))
+    for cpu in range(cpus):
+        topology = os.path.join(sys_cpu_path, 'cpu%s' % cpu, 'topology')
+        os.makedirs(topology)
+        thread = cpu - cpu % threads_per_core
+        socket = cpu - cpu % cpus_per_socket
+        write(os.path.join(topology, 'thread_siblings_list'),
+              '%s-%s' % (thread, thread + threads_per_core - 1))
+        write(os.path.join(topology, 'core_siblings_list'),
+              '%s-%s' % (socket, socket + cpus_per_socket - 1))
+        write(os.path.join(topology, 'thread_siblings'),
+              cpu_mask(range(thread, thread + threads_per_core), cpus))
+        write(os.path.join(topology, 'core_siblings'),
+              cpu_mask(range(socket, socket + cpus_per_socket), cpus))
+
+    os.makedirs(os.path.join(prefix, 'proc'))
+    write(os.path.join(prefix, 'proc/cpuinfo'),
+          "\n".join([CPU_TREE_CPUINFO % cpu for cpu in range(cpus)]))
@@ -2,6 +2,7 @@ import difflib
 import locale
 import os
 import pprint
+import shutil
 import unittest
 import sys
 import StringIO
@@ -20,6 +21,7 @@ from contextlib import contextmanager
 
 import stubs
 import subscription_manager.injection as inj
+from subscription_manager.cachestore import CacheStore
 
 # use instead of the normal pid file based ActionLock
 from threading import RLock
@@ -153,7 +155,9 @@ class SubManFixture(unittest.TestCase):
         # setup and mock the plugin_manager
         plugin_manager_mock = MagicMock(name='FixturePluginManagerMock')
         plugin_manager_mock.runiter.return_value = iter([])
-        inj.provide(inj.PLUGIN_MANAGER, plugin_manager_mock)
+        plugin_manager_mock.has_hooks.return_value = False
+        # a mock is callable, require() would hand out what calling it returns
+        inj.provide(inj.PLUGIN_MANAGER, lambda: plugin_manager_mock)
         inj.provide(inj.DBUS_IFACE, Mock(name='FixtureDbusIfaceMock'))
 
         pooltype_cache = Mock()
@@ -164,6 +168,11 @@ class SubManFixture(unittest.TestCase):
         self.stub_facts = stubs.StubFacts()
         inj.provide(inj.FACTS, self.stub_facts)
 
+        # Keep caches written by tests out of /var/lib/rhsm
+        self.cache_store_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.cache_store = CacheStore(os.path.join(self.cache_store_dir, 'rhsm_cache.db'))
+        inj.provide(inj.CACHE_STORE, self.cache_store)
+
         self.dbus_patcher = patch('subscription_manager.managercli.CliCommand._request_validity_check')
         self.dbus_patcher.start()
         # No tests should be trying to connect to any configure or test server
@@ -180,6 +189,9 @@ class SubManFixture(unittest.TestCase):
         self.mock_repofile_path_exists_patcher.stop()
         self.is_valid_server_patcher.stop()
 
+        self.cache_store.close()
+        shutil.rmtree(self.cache_store_dir, ignore_errors=True)
+
         for f in self.files_to_cleanup:
             # Assuming these are tempfile.NamedTemporaryFile, created with
             # the write_tempfile() method in this class.
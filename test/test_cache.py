@@ -18,8 +18,9 @@ import random
 import shutil
 import socket
 import tempfile
-import time
-from mock import Mock
+import zlib
+from StringIO import StringIO
+from mock import Mock, patch
 
 # used to get a user readable cfg class for test cases
 from stubs import StubProduct, StubProductCertificate, StubCertificateDirectory, \
@@ -29,7 +30,9 @@ from fixture import SubManFixture
 from rhsm import ourjson as json
 from subscription_manager.cache import ProfileManager, \
         InstalledProductsManager, EntitlementStatusCache, \
-        PoolTypeCache, ReleaseStatusCache
+        PoolTypeCache, ReleaseStatusCache, package_key, package_profile_digest
+from subscription_manager.cachestats import CacheStats
+from subscription_manager.cachestore import CacheStore
 
 from rhsm.profile import Package, RPMProfile
 
@@ -135,7 +138,7 @@ class TestProfileManager(unittest.TestCase):
         cached_profile = self._mock_pkg_profile(cached_pkgs)
 
         self.profile_mgr._cache_exists = Mock(return_value=True)
-        self.profile_mgr._read_cache = Mock(return_value=cached_profile)
+        self.profile_mgr._read_cache = Mock(return_value=self._digest(cached_profile))
 
         self.assertFalse(self.profile_mgr.has_changed())
         self.profile_mgr._read_cache.assert_called_with()
@@ -147,11 +150,27 @@ class TestProfileManager(unittest.TestCase):
         cached_profile = self._mock_pkg_profile(cached_pkgs)
 
         self.profile_mgr._cache_exists = Mock(return_value=True)
-        self.profile_mgr._read_cache = Mock(return_value=cached_profile)
+        self.profile_mgr._read_cache = Mock(return_value=self._digest(cached_profile))
 
         self.assertTrue(self.profile_mgr.has_changed())
         self.profile_mgr._read_cache.assert_called_with()
 
+    def test_load_data(self):
+        data = json.dumps(self.profile_mgr.to_dict())
+        self.assertEquals(self._digest(self.current_profile),
+                          self.profile_mgr._load_data(StringIO(data)))
+        self.assertEquals(2, json.loads(data)['count'])
+
+    def test_load_data_full_profile(self):
+        # packages.json written by older versions holds the whole profile
+        data = json.dumps(self.current_profile.collect())
+        self.assertEquals(self._digest(self.current_profile),
+                          self.profile_mgr._load_data(StringIO(data)))
+
+    @staticmethod
+    def _digest(profile):
+        return package_profile_digest([package_key(package) for package in profile.collect()])
+
     @staticmethod
     def _mock_pkg_profile(packages):
         """
@@ -169,6 +188,94 @@ class TestProfileManager(unittest.TestCase):
         return mock_profile
 
 
+class TestProfileManagerRpmdbFingerprint(SubManFixture):
+
+    def setUp(self):
+        super(TestProfileManagerRpmdbFingerprint, self).setUp()
+        self.rpmdb_dir = tempfile.mkdtemp()
+        self._write_rpmdb('Packages', 'some packages')
+        self.rpmdb_patcher = patch('subscription_manager.cache.RPMDB_PATH', self.rpmdb_dir)
+        self.rpmdb_patcher.start()
+
+        pkgs = [Package(name="package1", version="1.0.0", release=1, arch="x86_64")]
+        self.profile = TestProfileManager._mock_pkg_profile(pkgs)
+
+    def tearDown(self):
+        self.rpmdb_patcher.stop()
+        shutil.rmtree(self.rpmdb_dir)
+        super(TestProfileManagerRpmdbFingerprint, self).tearDown()
+
+    def _write_rpmdb(self, name, content):
+        f = open(os.path.join(self.rpmdb_dir, name), 'w')
+        f.write(content)
+        f.close()
+
+    def _profile_mgr(self):
+        profile_mgr = ProfileManager()
+        profile_mgr._get_profile = Mock(return_value=self.profile)
+        return profile_mgr
+
+    def test_unchanged_rpmdb_skips_profile(self):
+        profile_mgr = self._profile_mgr()
+        profile_mgr.current_profile
+        profile_mgr.write_cache()
+
+        profile_mgr = self._profile_mgr()
+        self.assertFalse(profile_mgr.has_changed())
+        self.assertEquals(0, profile_mgr._get_profile.call_count)
+
+    def test_db_environment_files_ignored(self):
+        profile_mgr = self._profile_mgr()
+        profile_mgr.current_profile
+        profile_mgr.write_cache()
+        self._write_rpmdb('__db.001', 'touched by a query')
+
+        profile_mgr = self._profile_mgr()
+        self.assertFalse(profile_mgr.has_changed())
+        self.assertEquals(0, profile_mgr._get_profile.call_count)
+
+    def test_changed_rpmdb_compares_profile(self):
+        profile_mgr = self._profile_mgr()
+        profile_mgr.current_profile
+        profile_mgr.write_cache()
+        self._write_rpmdb('Packages', 'some more packages')
+
+        profile_mgr = self._profile_mgr()
+        self.assertFalse(profile_mgr.has_changed())
+        self.assertEquals(1, profile_mgr._get_profile.call_count)
+
+        # the new fingerprint was taken
+        profile_mgr = self._profile_mgr()
+        self.assertFalse(profile_mgr.has_changed())
+        self.assertEquals(0, profile_mgr._get_profile.call_count)
+
+    def test_package_changes(self):
+        ProfileManager(current_profile=self.profile).write_cache()
+
+        pkgs = [Package(name="package2", version="2.0.0", release=2, arch="x86_64")]
+        profile_mgr = ProfileManager(
+            current_profile=TestProfileManager._mock_pkg_profile(pkgs))
+        self.assertTrue(profile_mgr.has_changed())
+        added, removed = profile_mgr.get_package_changes()
+        self.assertEquals([package_key(p) for p in profile_mgr.current_profile.collect()], added)
+        self.assertEquals([package_key(p) for p in self.profile.collect()], removed)
+
+    def test_package_keys_not_read_when_unchanged(self):
+        ProfileManager(current_profile=self.profile).write_cache()
+
+        profile_mgr = ProfileManager(current_profile=self.profile)
+        profile_mgr.get_package_changes = Mock()
+        self.assertFalse(profile_mgr.has_changed())
+        self.assertFalse(profile_mgr.get_package_changes.called)
+
+    def test_no_fingerprint_compares_profile(self):
+        ProfileManager(current_profile=self.profile).write_cache()
+
+        profile_mgr = self._profile_mgr()
+        self.assertFalse(profile_mgr.has_changed())
+        self.assertEquals(1, profile_mgr._get_profile.call_count)
+
+
 class TestInstalledProductsCache(SubManFixture):
 
     def setUp(self):
@@ -190,6 +297,16 @@ class TestInstalledProductsCache(SubManFixture):
         self.assertEquals("Product A", self.mgr.installed['a-product']['productName'])
         self.assertEquals(set(["product", "product-a", "product-b", "product-c"]), set(self.mgr.tags))
 
+    def test_unchanged_products_not_rebuilt(self):
+        payload = self.mgr.format_for_server()
+        self.assertTrue(payload is self.mgr.format_for_server())
+
+        self.prod_dir.certs.append(StubProductCertificate(
+            StubProduct('d-product', name="Product D", provided_tags="product-d")))
+        payload = self.mgr.format_for_server()
+        self.assertEquals(4, len(payload))
+        self.assertTrue('product-d' in self.mgr.tags)
+
     def test_load_data(self):
         cached = {
                 'products': {
@@ -416,37 +533,148 @@ class TestEntitlementStatusCache(SubManFixture):
         mock_server_status = {'fake server status': random.uniform(1, 2 ** 32)}
         status_cache = EntitlementStatusCache()
         status_cache.server_status = mock_server_status
-        cache_dir = tempfile.mkdtemp()
-        cache_file = os.path.join(cache_dir, 'status_cache.json')
-        status_cache.CACHE_FILE = cache_file
         status_cache.write_cache()
 
-        # try to load the file 5 times, if
-        # we still can't read it, fail
-        # we don't know when the write_cache thread ends or
-        # when it starts. Need to track the cache threads
-        # but we do not...
-
-        tries = 0
-        while tries <= 5:
-            try:
-                new_status_buf = open(cache_file).read()
-                new_status = json.loads(new_status_buf)
-                break
-            except Exception, e:
-                log.exception(e)
-                tries += 1
-                time.sleep(.1)
-                continue
-
-        shutil.rmtree(cache_dir)
+        # reading it back waits for the queued write
+        new_status = EntitlementStatusCache()._read_cache()
         self.assertEquals(new_status, mock_server_status)
 
+    def test_write_cache_committed_to_store(self):
+        mgr = InstalledProductsManager()
+        mgr.write_cache()
+        self.cache_store.flush()
+
+        # A new store reads what the first one committed
+        store = CacheStore(self.cache_store.path)
+        self.assertEquals(json.loads(store.get(mgr.CACHE_FILE))['products'],
+                          mgr.installed)
+
+    def test_read_legacy_cache_file(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache_file = os.path.join(cache_dir, 'status_cache.json')
+            with patch.object(EntitlementStatusCache, 'CACHE_FILE', cache_file):
+                status_cache = EntitlementStatusCache()
+                f = open(cache_file, 'w')
+                f.write(json.dumps({'status': 'valid'}))
+                f.close()
+
+                self.assertTrue(status_cache._cache_exists())
+                self.assertEquals({'status': 'valid'}, status_cache._read_cache())
+
+                status_cache.delete_cache()
+                self.assertFalse(os.path.exists(cache_file))
+                self.assertFalse(status_cache._cache_exists())
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_legacy_cache_file_removed_when_written(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache_file = os.path.join(cache_dir, 'status_cache.json')
+            with patch.object(EntitlementStatusCache, 'CACHE_FILE', cache_file):
+                f = open(cache_file, 'w')
+                f.write(json.dumps({'status': 'old'}))
+                f.close()
+
+                status_cache = EntitlementStatusCache()
+                status_cache.server_status = {'status': 'valid'}
+                status_cache.write_cache()
+                self.cache_store.run_queued()
+
+                self.assertFalse(os.path.exists(cache_file))
+                self.assertEquals({'status': 'valid'},
+                                  EntitlementStatusCache()._read_cache())
+        finally:
+            shutil.rmtree(cache_dir)
+
     def test_unauthorized_exception_handled(self):
         uep = Mock()
         uep.getCompliance = Mock(side_effect=UnauthorizedException(401, "GET"))
         self.assertEquals(None, self.status_cache.load_status(uep, "aaa"))
 
+    def test_written_compressed(self):
+        status_cache = EntitlementStatusCache()
+        status_cache.server_status = {'status': 'valid'}
+        data = status_cache._store_items()[status_cache.CACHE_FILE]
+        self.assertEquals('{"status":"valid"}', zlib.decompress(data))
+
+        self.cache_store.put(status_cache.CACHE_FILE, data)
+        self.assertEquals({'status': 'valid'}, EntitlementStatusCache()._read_cache())
+
+    def test_read_uncompressed(self):
+        self.cache_store.put(EntitlementStatusCache.CACHE_FILE,
+                             json.dumps({'status': 'valid'}))
+        self.assertEquals({'status': 'valid'}, EntitlementStatusCache()._read_cache())
+
+    def _write_fresh_cache(self, status):
+        cache = EntitlementStatusCache()
+        cache.server_status = status
+        self.cache_store.put_many(cache._store_items())
+
+    def test_fresh_cache_served_without_server(self):
+        self._write_fresh_cache({"a": "1"})
+        uep = Mock()
+
+        status = EntitlementStatusCache().load_status(uep, "SOMEUUID")
+        self.assertEquals({"a": "1"}, status)
+        self.assertEquals(0, uep.getCompliance.call_count)
+
+    @patch('subscription_manager.cache.cfg')
+    def test_expired_cache_not_served(self, mock_cfg):
+        # entitlement_status_cache_ttl = 0 in rhsm.conf
+        mock_cfg.has_option.return_value = True
+        mock_cfg.get_int.return_value = 0
+        self._write_fresh_cache({"a": "1"})
+        uep = Mock()
+        uep.getCompliance = Mock(return_value={"a": "2"})
+
+        status_cache = EntitlementStatusCache()
+        status_cache.write_cache = Mock()
+        self.assertEquals({"a": "2"}, status_cache.load_status(uep, "SOMEUUID"))
+        mock_cfg.get_int.assert_called_with('rhsm', 'entitlement_status_cache_ttl')
+
+    def test_cache_for_other_consumer_not_served(self):
+        self._write_fresh_cache({"a": "1"})
+        inj.require(inj.IDENTITY).uuid = 'another_uuid'
+        uep = Mock()
+        uep.getCompliance = Mock(return_value={"a": "2"})
+
+        status_cache = EntitlementStatusCache()
+        status_cache.write_cache = Mock()
+        self.assertEquals({"a": "2"}, status_cache.load_status(uep, "SOMEUUID"))
+
+    def test_state_changed_during_fetch_not_fresh(self):
+        def get_compliance(uuid):
+            # the local state changes while the server answers
+            inj.require(inj.IDENTITY).uuid = 'another_uuid'
+            return {"a": "2"}
+        uep = Mock()
+        uep.getCompliance = Mock(side_effect=get_compliance)
+
+        EntitlementStatusCache().load_status(uep, "SOMEUUID")
+        self.cache_store.run_queued()
+        self.assertFalse(EntitlementStatusCache()._is_fresh())
+
+    @patch('subscription_manager.cache.cache_stats', new_callable=CacheStats)
+    def test_stats(self, stats):
+        self._write_fresh_cache({"a": "1"})
+        EntitlementStatusCache().load_status(Mock(), "SOMEUUID")
+
+        inj.require(inj.IDENTITY).uuid = 'another_uuid'
+        uep = Mock()
+        uep.getCompliance = Mock(return_value={"a": "2"})
+        EntitlementStatusCache().load_status(uep, "SOMEUUID")
+        self.cache_store.run_queued()
+
+        counts = stats.get(EntitlementStatusCache.CACHE_FILE)
+        self.assertEquals(1, counts['fresh'])
+        self.assertEquals(1, counts['hit'])
+        self.assertEquals(1, counts['stale'])
+        self.assertEquals(1, counts['sync'])
+        self.assertEquals(1, counts['write'])
+        self.assertTrue(counts['bytes_written'] > 0)
+
 
 class TestPoolTypeCache(SubManFixture):
 
@@ -523,6 +751,30 @@ class TestPoolTypeCache(SubManFixture):
         # No ents have pools so there is nothing we can update
         self.assertFalse(pooltype_cache.requires_update())
 
+    def test_persisted_for_same_attachments(self):
+        inj.provide(inj.ENT_DIR, self.ent_dir)
+        self.cp.getEntitlementList.return_value = [self._build_ent_json('someid', 'some type')]
+        PoolTypeCache()
+        self.assertEquals(1, self.cp.getEntitlementList.call_count)
+
+        pooltype_cache = PoolTypeCache()
+        self.assertEquals(1, self.cp.getEntitlementList.call_count)
+        self.assertEquals('some type', pooltype_cache.get('someid'))
+
+    def test_persisted_ignored_for_other_attachments(self):
+        inj.provide(inj.ENT_DIR, self.ent_dir)
+        self.cp.getEntitlementList.return_value = [self._build_ent_json('someid', 'some type')]
+        PoolTypeCache()
+
+        self.ent_dir.certs.append(StubEntitlementCertificate(StubProduct('pid2'),
+                                                             pool=StubPool('otherid')))
+        self.cp.getEntitlementList.return_value = [
+                self._build_ent_json('someid', 'some type'),
+                self._build_ent_json('otherid', 'other type')]
+        pooltype_cache = PoolTypeCache()
+        self.assertEquals(2, self.cp.getEntitlementList.call_count)
+        self.assertEquals('other type', pooltype_cache.get('otherid'))
+
     def _build_ent_json(self, pool_id, pool_type):
         result = {}
         result['id'] = "1234"
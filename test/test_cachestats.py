@@ -0,0 +1,60 @@
+#
+# Copyright (c) 2015 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+import unittest
+
+from subscription_manager.cachestats import CacheStats
+
+
+class CacheStatsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = CacheStats()
+
+    def test_empty(self):
+        self.assertEquals({}, self.stats.get())
+        self.assertEquals(0, self.stats.get('a')['hit'])
+        self.assertEquals([], self.stats.summary())
+
+    def test_record(self):
+        self.stats.record('a', 'hit', bytes_read=10)
+        self.stats.record('a', 'hit', bytes_read=5)
+        self.stats.record('a', 'sync', sync_time=0.5)
+        self.stats.record('b', 'miss')
+
+        a = self.stats.get('a')
+        self.assertEquals(2, a['hit'])
+        self.assertEquals(15, a['bytes_read'])
+        self.assertEquals(1, a['sync'])
+        self.assertEquals(0.5, a['sync_time'])
+        self.assertEquals(1, self.stats.get()['b']['miss'])
+
+    def test_get_returns_copy(self):
+        self.stats.record('a', 'hit')
+        self.stats.get('a')['hit'] = 10
+        self.assertEquals(1, self.stats.get('a')['hit'])
+
+    def test_summary(self):
+        self.stats.record('b', 'write', bytes_written=20)
+        self.stats.record('a', 'miss')
+        summary = self.stats.summary()
+        self.assertEquals(2, len(summary))
+        self.assertTrue(summary[0].startswith('a: hit=0 miss=1 '))
+        self.assertTrue('bytes_written=20' in summary[1])
+
+    def test_reset(self):
+        self.stats.record('a', 'hit')
+        self.stats.reset()
+        self.assertEquals({}, self.stats.get())
@@ -0,0 +1,147 @@
+#
+# Copyright (c) 2015 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+import os
+import tempfile
+import threading
+import unittest
+from shutil import rmtree
+
+from mock import patch
+
+from subscription_manager.cachestore import CacheStore
+
+
+class CacheStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.path = os.path.join(self.temp_dir, 'cache', 'rhsm_cache.db')
+        self.store = CacheStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        rmtree(self.temp_dir)
+
+    def test_missing(self):
+        self.assertEquals(None, self.store.get('nothing'))
+        self.assertFalse(self.store.exists('nothing'))
+        self.assertEquals(None, self.store.mtime('nothing'))
+
+    def test_writes_visible(self):
+        self.store.put('a', '{"a": 1}')
+        self.assertEquals('{"a": 1}', self.store.get('a'))
+        self.assertTrue(self.store.mtime('a') is not None)
+
+    def test_writes_committed(self):
+        self.store.put('a', 'one')
+        self.store.put_many({'b': 'two', 'c': 'three'})
+
+        # seen by other processes without a flush
+        other = CacheStore(self.path)
+        self.assertEquals('one', other.get('a'))
+        self.assertEquals('two', other.get('b'))
+        self.assertEquals('three', other.get('c'))
+        other.close()
+
+    def test_failed_write_retried(self):
+        # the store's directory can not be created while a file is there
+        blocker = os.path.join(self.temp_dir, 'cache')
+        open(blocker, 'w').close()
+        self.store.put('a', 'one')
+        self.assertEquals('one', self.store.get('a'))
+
+        os.remove(blocker)
+        self.store.flush()
+        self.assertEquals('one', CacheStore(self.path).get('a'))
+
+    @patch('subscription_manager.cachestore.log')
+    def test_failed_producer_logged(self, mock_log):
+        def producer():
+            raise ValueError("no data")
+        # no writer thread to race with
+        self.store._writer = threading.Thread()
+        self.store.put_async('a', producer)
+        self.store.run_queued()
+        self.assertEquals(None, self.store.get('a'))
+        self.assertTrue('a' in mock_log.warn.call_args[0][0])
+
+    def test_binary_data(self):
+        data = ''.join(chr(i) for i in range(256))
+        self.store.put('a', data)
+        self.store.flush()
+        self.assertEquals(data, CacheStore(self.path).get('a'))
+
+    def test_delete(self):
+        self.store.put('a', 'one')
+        self.store.flush()
+        self.store.delete('a')
+        self.assertEquals(None, self.store.get('a'))
+        self.store.flush()
+        self.assertEquals(None, CacheStore(self.path).get('a'))
+
+    def test_unreadable_store_replaced(self):
+        os.makedirs(os.path.dirname(self.path))
+        f = open(self.path, 'w')
+        f.write('this is not a database' * 100)
+        f.close()
+
+        self.assertEquals(None, self.store.get('a'))
+        self.store.put('a', 'one')
+        self.store.flush()
+        self.assertEquals('one', CacheStore(self.path).get('a'))
+
+    def test_put_async(self):
+        self.store.put_async('a', lambda: {'a': 'one', 'a.state': 'state'})
+        self.store.run_queued()
+        self.assertEquals('one', self.store.get('a'))
+        self.assertEquals('state', self.store.get('a.state'))
+        self.assertEquals('one', CacheStore(self.path).get('a'))
+
+    def test_put_async_read_waits(self):
+        self.store.put_async('a', lambda: {'a': 'one'})
+        self.assertEquals('one', self.store.get('a'))
+
+    def test_put_async_last_write_wins(self):
+        calls = []
+
+        def producer(value):
+            def produce():
+                calls.append(value)
+                return {'b': value}
+            return produce
+
+        # keep the writer busy until both writes are queued
+        writer_busy = threading.Event()
+
+        def busy():
+            writer_busy.wait(5)
+            return {}
+
+        self.store.put_async('a', busy)
+        self.store.put_async('b', producer('first'))
+        self.store.put_async('b', producer('second'))
+        writer_busy.set()
+        self.store.flush()
+
+        self.assertEquals(['second'], calls)
+        self.assertEquals('second', CacheStore(self.path).get('b'))
+
+    def test_one_writer_thread(self):
+        self.store.put_async('a', lambda: {'a': 'one'})
+        writer = self.store._writer
+        self.store.run_queued()
+        self.store.put_async('b', lambda: {'b': 'two'})
+        self.assertTrue(writer is self.store._writer)
@@ -0,0 +1,195 @@
+#
+# Copyright (c) 2015 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+from mock import MagicMock, patch
+
+from stubs import StubProduct, StubProductCertificate
+from subscription_manager.certcache import CertificateCache, LazyCertificate
+from subscription_manager.certdirectory import ProductCertificateDirectory
+
+
+class FakeCert(object):
+    def __init__(self, serial):
+        self.serial = serial
+        self.path = '/etc/pki/entitlement/%s.pem' % serial
+        self.order = 'order-%s' % serial
+        self.x509 = object()
+
+    def key_path(self):
+        return '/etc/pki/entitlement/%s-key.pem' % self.serial
+
+
+class CertificateCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.cert_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.cert_path = os.path.join(self.cert_dir, '1.pem')
+        open(self.cert_path, 'w').close()
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+        rmtree(self.cert_dir)
+
+    def _cache(self):
+        return CertificateCache(self.cert_dir, cache_dir=self.cache_dir)
+
+    def _put(self, cache, cert):
+        cache.put(self.cert_path, cache.stat_key(self.cert_path), cert)
+
+    def test_miss(self):
+        cache = self._cache()
+        self.assertEquals(None, cache.get(self.cert_path, cache.stat_key(self.cert_path)))
+
+    def test_persisted(self):
+        cache = self._cache()
+        self._put(cache, FakeCert(1))
+        cache.write()
+
+        cache = self._cache()
+        cert = cache.get(self.cert_path, cache.stat_key(self.cert_path))
+        self.assertEquals(1, cert.serial)
+        self.assertEquals(None, cert.x509)
+
+    def test_lazy(self):
+        cache = self._cache()
+        self._put(cache, FakeCert(1))
+        cache.write()
+
+        cache = self._cache()
+        cert = cache.get(self.cert_path, cache.stat_key(self.cert_path))
+        self.assertTrue(isinstance(cert, LazyCertificate))
+        self.assertEquals(1, cert.serial)
+        self.assertEquals('/etc/pki/entitlement/1.pem', cert.path)
+        self.assertEquals('/etc/pki/entitlement/1-key.pem', cert.key_path())
+        self.assertEquals(None, cert.__dict__['_cert'])
+
+        self.assertEquals('order-1', cert.order)
+        self.assertTrue(isinstance(cert.__dict__['_cert'], FakeCert))
+
+    def test_lazy_isinstance(self):
+        cache = self._cache()
+        self._put(cache, FakeCert(1))
+        cache.write()
+
+        cert = self._cache().get(self.cert_path, cache.stat_key(self.cert_path))
+        self.assertTrue(isinstance(cert, FakeCert))
+        self.assertTrue(isinstance(cert, LazyCertificate))
+        self.assertEquals(None, cert.__dict__['_cert'])
+
+    def test_lazy_setattr_not_loaded(self):
+        cache = self._cache()
+        self._put(cache, FakeCert(1))
+        cache.write()
+
+        cert = self._cache().get(self.cert_path, cache.stat_key(self.cert_path))
+        cert.serial = 2
+        self.assertEquals(2, cert.serial)
+        self.assertEquals(None, cert.__dict__['_cert'])
+        # kept once the certificate is loaded
+        self.assertEquals('order-1', cert.order)
+        self.assertEquals(2, cert.__dict__['_cert'].serial)
+
+    def test_lazy_unreadable_blob_parsed_again(self):
+        cert = LazyCertificate(self.cert_path, {'serial': 1}, 'not a pickle')
+        with patch('subscription_manager.certcache.create_from_file') as mock_cff:
+            mock_cff.return_value = FakeCert(1)
+            self.assertEquals('order-1', cert.order)
+            mock_cff.assert_called_once_with(self.cert_path)
+
+    def test_changed_file_is_a_miss(self):
+        cache = self._cache()
+        self._put(cache, FakeCert(1))
+        cache.write()
+
+        f = open(self.cert_path, 'w')
+        f.write('changed')
+        f.close()
+        cache = self._cache()
+        self.assertEquals(None, cache.get(self.cert_path, cache.stat_key(self.cert_path)))
+
+    def test_prune(self):
+        cache = self._cache()
+        self._put(cache, FakeCert(1))
+        cache.prune([])
+        cache.write()
+
+        cache = self._cache()
+        self.assertEquals(None, cache.get(self.cert_path, cache.stat_key(self.cert_path)))
+
+    def test_unpicklable_cert_not_cached(self):
+        cache = self._cache()
+        self._put(cache, MagicMock())
+        cache.write()
+        self.assertFalse(os.path.exists(cache.cache_file))
+
+    def test_group_writable_cache_ignored(self):
+        cache = self._cache()
+        self._put(cache, FakeCert(1))
+        cache.write()
+        os.chmod(cache.cache_file, 0664)
+
+        cache = self._cache()
+        self.assertEquals(None, cache.get(self.cert_path, cache.stat_key(self.cert_path)))
+
+    def test_delete(self):
+        cache = self._cache()
+        self._put(cache, FakeCert(1))
+        cache.write()
+        cache.delete()
+        self.assertFalse(os.path.exists(cache.cache_file))
+
+
+class CertificateDirectoryCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.cert_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        for i in range(1, 4):
+            open(os.path.join(self.cert_dir, '%s.pem' % i), 'w').close()
+
+        self.cache_dir_patcher = patch('subscription_manager.certcache.CERT_CACHE_DIR', self.cache_dir)
+        self.cache_dir_patcher.start()
+        self.cff_patcher = patch('subscription_manager.certdirectory.create_from_file')
+        self.mock_cff = self.cff_patcher.start()
+        self.mock_cff.side_effect = lambda path: StubProductCertificate(StubProduct(path))
+
+    def tearDown(self):
+        self.cff_patcher.stop()
+        self.cache_dir_patcher.stop()
+        rmtree(self.cache_dir)
+        rmtree(self.cert_dir)
+
+    def test_unchanged_certs_not_parsed_again(self):
+        first = ProductCertificateDirectory(path=self.cert_dir).list()
+        self.assertEquals(3, self.mock_cff.call_count)
+
+        second = ProductCertificateDirectory(path=self.cert_dir).list()
+        self.assertEquals(3, self.mock_cff.call_count)
+        self.assertEquals(sorted(c.serial for c in first),
+                          sorted(c.serial for c in second))
+
+    def test_new_cert_parsed(self):
+        ProductCertificateDirectory(path=self.cert_dir).list()
+        open(os.path.join(self.cert_dir, '4.pem'), 'w').close()
+
+        listing = ProductCertificateDirectory(path=self.cert_dir).list()
+        self.assertEquals(4, len(listing))
+        self.assertEquals(4, self.mock_cff.call_count)
@@ -16,14 +16,19 @@
 import tempfile
 import unittest
 import os
+from datetime import datetime, timedelta
 
 from mock import patch, MagicMock
 from shutil import rmtree
 
+from rhsm.certificate import DateRange, GMT
+
 from stubs import StubProduct, StubEntitlementCertificate, \
-    StubProductCertificate
+    StubProductCertificate, StubEntitlementDirectory
 from subscription_manager.certdirectory import Path, EntitlementDirectory, \
-    ProductDirectory, ProductCertificateDirectory, Directory
+    ProductDirectory, ProductCertificateDirectory, Directory, DateRangeIndex, \
+    Writer
+from subscription_manager import injection as inj
 from subscription_manager.repolib import RepoFile
 from subscription_manager.productid import ProductDatabase
 
@@ -211,6 +216,8 @@ class EntitlementDirectoryWithCertsTest(DirectoryWithCertsTest):
         self.mock_cert = MagicMock()
         self.mock_cert.serial = '37'
         self.mock_cert.is_expired.return_value = False
+        self.mock_cert.valid_range = DateRange(datetime.now() - timedelta(days=1),
+                                               datetime.now() + timedelta(days=365))
         self.mock_cert.products = [mock_product]
 
         self.mock_cff.return_value = self.mock_cert
@@ -253,6 +260,31 @@ class EntitlementDirectoryWithCertsTest(DirectoryWithCertsTest):
         res = self.d.list_valid()
         self.assertEquals(len(res), self.list_len)
 
+    @patch('os.geteuid')
+    def test_list_valid_keys_from_listing(self, mock_geteuid):
+        mock_geteuid.return_value = 0
+        self.mock_cert.key_path.return_value = os.path.join(self.temp_dir, '1-key.pem')
+        with patch('os.access') as mock_access:
+            res = self.d.list_valid()
+            self.assertFalse(mock_access.called)
+        self.assertEquals(len(res), self.list_len)
+
+    @patch('os.geteuid')
+    def test_list_valid_missing_key(self, mock_geteuid):
+        mock_geteuid.return_value = 0
+        self.mock_cert.key_path.return_value = os.path.join(self.temp_dir, '99-key.pem')
+        res = self.d.list_valid()
+        self.assertEquals(len(res), 0)
+
+    def test_list_valid_checks_key_of_expired(self):
+        self.mock_cert.valid_range = DateRange(datetime.now() - timedelta(days=365),
+                                               datetime.now() - timedelta(days=1))
+        with patch.object(self.d, '_check_key') as mock_check_key:
+            mock_check_key.return_value = True
+            res = self.d.list_valid()
+            self.assertEquals(self.list_len, mock_check_key.call_count)
+        self.assertEquals(len(res), 0)
+
     def test_list_for_product(self):
         res = self.d.list_for_product('123')
         self.assertTrue(isinstance(res, list))
@@ -282,6 +314,8 @@ class ProductCertificateDirectoryWithCertsTest(DirectoryWithCertsTest):
         self.mock_cert.products = [mock_product]
         self.mock_cert.serial = '37'
         self.mock_cert.is_expired.return_value = False
+        self.mock_cert.valid_range = DateRange(datetime.now() - timedelta(days=1),
+                                               datetime.now() + timedelta(days=365))
 
         self.mock_cff.return_value = self.mock_cert
         self.d = self._get_directory()
@@ -302,6 +336,8 @@ class ProductCertificateDirectoryWithCertsTest(DirectoryWithCertsTest):
 
     def test_list_expired_some_expired(self):
         self.mock_cert.is_expired.return_value = True
+        self.mock_cert.valid_range = DateRange(datetime.now() - timedelta(days=365),
+                                               datetime.now() - timedelta(days=1))
         res = self.d.list_expired()
         self.assertTrue(isinstance(res, list))
         self.assertEquals(len(res), self.list_len)
@@ -350,6 +386,63 @@ class ProductCertificateDirectoryWithCertsTest(DirectoryWithCertsTest):
         self.d.refresh()
         self.d.list()
 
+    def test_refresh_only_loads_new_certs(self):
+        self.d.list()
+        self.assertEquals(self.list_len, self.mock_cff.call_count)
+        open(os.path.join(self.d.path, '5.pem'), 'w').close()
+        self.d.refresh()
+        self.assertEquals(self.list_len + 1, len(self.d.list()))
+        self.assertEquals(self.list_len + 1, self.mock_cff.call_count)
+
+    def test_refresh_drops_removed_certs(self):
+        self.d.list()
+        os.unlink(os.path.join(self.d.path, '1.pem'))
+        self.d.refresh()
+        self.assertEquals(self.list_len - 1, len(self.d.list()))
+        self.assertEquals(self.list_len, self.mock_cff.call_count)
+
+    def test_generation(self):
+        generation = self.d.generation()
+        self.d.refresh()
+        self.assertEquals(generation, self.d.generation())
+
+        open(os.path.join(self.d.path, '5.pem'), 'w').close()
+        self.d.refresh()
+        self.assertNotEquals(generation, self.d.generation())
+
+    def test_full_refresh(self):
+        self.d.list()
+        self.d.refresh(full=True)
+        self.d.list()
+        self.assertEquals(2 * self.list_len, self.mock_cff.call_count)
+
+    @patch('subscription_manager.certdirectory._parse_certs_in_pool')
+    @patch('subscription_manager.certdirectory._parse_workers')
+    def test_parse_small_directory_serially(self, mock_workers, mock_pool):
+        mock_workers.return_value = 4
+        self.d.list()
+        self.assertFalse(mock_pool.called)
+        self.assertEquals(self.list_len, self.mock_cff.call_count)
+
+    @patch('subscription_manager.certdirectory.PARALLEL_PARSE_MIN', 2)
+    @patch('subscription_manager.certdirectory._parse_certs_in_pool')
+    @patch('subscription_manager.certdirectory._parse_workers')
+    def test_parse_in_pool(self, mock_workers, mock_pool):
+        mock_workers.return_value = 4
+        mock_pool.side_effect = lambda paths, workers: [self.mock_cert] * len(paths)
+        self.assertEquals(self.list_len, len(self.d.list()))
+        self.assertTrue(mock_pool.called)
+        self.assertEquals(0, self.mock_cff.call_count)
+
+    @patch('subscription_manager.certdirectory.PARALLEL_PARSE_MIN', 2)
+    @patch('subscription_manager.certdirectory._parse_certs_in_pool')
+    @patch('subscription_manager.certdirectory._parse_workers')
+    def test_parse_in_pool_failure_falls_back(self, mock_workers, mock_pool):
+        mock_workers.return_value = 4
+        mock_pool.side_effect = OSError()
+        self.assertEquals(self.list_len, len(self.d.list()))
+        self.assertEquals(self.list_len, self.mock_cff.call_count)
+
     def test_clean(self):
         self.d.clean()
 
@@ -399,6 +492,24 @@ class AlsoProductDirectoryTest(unittest.TestCase):
         self.assertTrue("top" in resulting_ids)
         self.assertTrue("default" in resulting_ids)
 
+    @patch('os.path.exists')
+    def test_merged_list_memoized(self, MockExists):
+        MockExists.return_value = True
+        pd = ProductDirectory()
+        installed = [StubProductCertificate(StubProduct("top"), [])]
+        default = [StubProductCertificate(StubProduct("default"), [])]
+        pd.installed_prod_dir.list = lambda: installed
+        pd.default_prod_dir.list = lambda: default
+        results = pd.list()
+        self.assertTrue(results is pd.list())
+        self.assertEquals(set(["top", "default"]), set(pd.get_installed_products()))
+
+        # a reloaded listing is merged again
+        installed = [StubProductCertificate(StubProduct("other"), [])]
+        self.assertEquals(["other", "default"],
+                          [cert.products[0].id for cert in pd.list()])
+        self.assertEquals(set(["other", "default"]), set(pd.get_installed_products()))
+
     @patch('os.path.exists')
     def test_default_products_matching_ids(self, MockExists):
         MockExists.return_value = True
@@ -411,3 +522,144 @@ class AlsoProductDirectoryTest(unittest.TestCase):
         self.assertEquals(1, len(results))
         resulting_ids = [cert.products[0].id for cert in results]
         self.assertTrue("top" in resulting_ids)
+
+
+class CertificateIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.provides = StubEntitlementCertificate(StubProduct("p1"), stacking_id="s1")
+        self.stacked = StubEntitlementCertificate(StubProduct("p2"), stacking_id="s1")
+        self.other = StubEntitlementCertificate(StubProduct("p3"), stacking_id="s2")
+        self.ent_dir = StubEntitlementDirectory([self.provides, self.stacked, self.other])
+
+    def test_find(self):
+        self.assertEquals(self.stacked, self.ent_dir.find(self.stacked.serial))
+        self.assertEquals(None, self.ent_dir.find(1))
+
+    def test_find_all_by_product_includes_stack(self):
+        res = self.ent_dir.find_all_by_product("p1")
+        self.assertEquals(set([self.provides, self.stacked]), set(res))
+
+    def test_list_for_product(self):
+        self.assertEquals([self.other], self.ent_dir.list_for_product("p3"))
+        self.assertEquals([], self.ent_dir.list_for_product("p4"))
+
+    def test_index_follows_listing(self):
+        self.assertEquals(None, self.ent_dir.find_by_product("p4"))
+        added = StubEntitlementCertificate(StubProduct("p4"))
+        self.ent_dir.certs.append(added)
+        self.assertEquals(added, self.ent_dir.find_by_product("p4"))
+
+    def test_refresh_drops_index(self):
+        self.ent_dir.find(self.stacked.serial)
+        self.ent_dir.refresh()
+        self.assertEquals(None, self.ent_dir._index)
+
+
+class DateRangeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime.now(GMT())
+        days = lambda n: self.now + timedelta(days=n)
+        self.expired = StubEntitlementCertificate(StubProduct("p1"),
+                start_date=days(-20), end_date=days(-10))
+        self.current = StubEntitlementCertificate(StubProduct("p2"),
+                start_date=days(-5), end_date=days(5))
+        self.long = StubEntitlementCertificate(StubProduct("p3"),
+                start_date=days(-30), end_date=days(30))
+        self.future = StubEntitlementCertificate(StubProduct("p4"),
+                start_date=days(10), end_date=days(20))
+        self.certs = [self.expired, self.current, self.long, self.future]
+        self.index = DateRangeIndex(self.certs)
+
+    def test_valid_on(self):
+        self.assertEquals([self.current, self.long], self.index.valid_on())
+        self.assertEquals([self.expired, self.long],
+                          self.index.valid_on(self.now - timedelta(days=15)))
+        self.assertEquals([self.long, self.future],
+                          self.index.valid_on(self.now + timedelta(days=15)))
+        self.assertEquals([], self.index.valid_on(self.now + timedelta(days=60)))
+
+    def test_valid_on_matches_is_valid(self):
+        for offset in range(-40, 40, 3):
+            on_date = self.now + timedelta(days=offset)
+            expected = [c for c in self.certs if c.valid_range.has_date(on_date)]
+            self.assertEquals(expected, self.index.valid_on(on_date))
+
+    def test_expired_on(self):
+        self.assertEquals([self.expired], self.index.expired_on())
+        self.assertEquals([self.expired, self.current],
+                          self.index.expired_on(self.now + timedelta(days=6)))
+
+    def test_overlapping(self):
+        self.assertEquals([self.current, self.long, self.future],
+                          self.index.overlapping(self.now + timedelta(days=1),
+                                                 self.now + timedelta(days=12)))
+        self.assertEquals([], self.index.overlapping(self.now + timedelta(days=31),
+                                                     self.now + timedelta(days=40)))
+
+    def test_empty(self):
+        index = DateRangeIndex([])
+        self.assertEquals([], index.valid_on())
+        self.assertEquals([], index.expired_on())
+        self.assertEquals([], index.overlapping(self.now, self.now))
+
+
+class WriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.path_patcher = patch.object(EntitlementDirectory, 'PATH', self.temp_dir)
+        self.path_patcher.start()
+        ent_dir = EntitlementDirectory()
+        inj.provide(inj.ENT_DIR, lambda: ent_dir)
+
+    def tearDown(self):
+        self.path_patcher.stop()
+        rmtree(self.temp_dir)
+
+    def _write_file(self, content):
+        def write(path):
+            f = open(path, 'w')
+            f.write(content)
+            f.close()
+        return write
+
+    def _key_cert(self, serial):
+        key = MagicMock()
+        key.write.side_effect = self._write_file('key %s' % serial)
+        cert = MagicMock()
+        cert.serial = serial
+        cert.write.side_effect = self._write_file('cert %s' % serial)
+        return key, cert
+
+    def test_write_all(self):
+        pairs = [self._key_cert(1), self._key_cert(2)]
+        Writer().write_all(pairs)
+
+        self.assertEquals(['1-key.pem', '1.pem', '2-key.pem', '2.pem'],
+                          sorted(os.listdir(self.temp_dir)))
+        self.assertEquals('cert 2', open(os.path.join(self.temp_dir, '2.pem')).read())
+        self.assertEquals(os.path.join(self.temp_dir, '1.pem'), pairs[0][1].path)
+        self.assertEquals(os.path.join(self.temp_dir, '1-key.pem'), pairs[0][0].path)
+
+    @patch('subscription_manager.certdirectory._fsync')
+    def test_write_all_fsyncs_staged_files(self, mock_fsync):
+        Writer().write_all([self._key_cert(1)])
+        synced = [call[0][0] for call in mock_fsync.call_args_list]
+        self.assertEquals(['1-key.pem', '1.pem'],
+                          [os.path.basename(path) for path in synced[:2]])
+        self.assertTrue(os.path.basename(os.path.dirname(synced[0])).startswith('.staging-'))
+        self.assertEquals(self.temp_dir, synced[2])
+
+    def test_write_all_failure_installs_nothing(self):
+        pairs = [self._key_cert(1), self._key_cert(2)]
+        pairs[1][1].write.side_effect = IOError("disk full")
+
+        self.assertRaises(IOError, Writer().write_all, pairs)
+        self.assertEquals([], os.listdir(self.temp_dir))
+
+    def test_write(self):
+        key, cert = self._key_cert(3)
+        Writer().write(key, cert)
+        self.assertEquals(['3-key.pem', '3.pem'], sorted(os.listdir(self.temp_dir)))
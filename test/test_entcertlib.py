@@ -65,7 +65,7 @@ class TestEntCertUpdateReport(fixture.SubManFixture):
 class UpdateActionTests(fixture.SubManFixture):
 
     @patch("subscription_manager.entcertlib.EntitlementCertBundleInstaller.build_cert")
-    @patch.object(Writer, "write")
+    @patch.object(Writer, "write_all")
     def test_expired_are_not_ignored_when_installing_certs(self, write_mock, build_cert_mock):
         valid_ent = StubEntitlementCertificate(StubProduct("PValid"))
         expired_ent = StubEntitlementCertificate(StubProduct("PExpired"),
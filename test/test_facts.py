@@ -1,6 +1,6 @@
 import tempfile
 import shutil
-from mock import patch
+from mock import Mock, patch
 
 import fixture
 from stubs import StubEntitlementDirectory, StubProductDirectory
@@ -124,6 +124,44 @@ def stub_get_facts():
     return {'newstuff': True}
 
 
+class StubHardware(object):
+    COLLECTORS = [('cpu', 'get_cpu_info'), ('network', 'get_network_info')]
+
+    stamps = {}
+    found = {}
+    ran = []
+    hung = []
+
+    def __init__(self, collector_cache=None, exclude_interfaces=None):
+        self.collector_stamps = {}
+        self.collector_facts = {}
+        self.timed_out = []
+
+    def collector_inputs(self, name):
+        return self.stamps.get(name)
+
+    def run_collector(self, name):
+        self.ran.append(name)
+        return dict(self.found[name])
+
+    def run_collectors(self, names):
+        for name in names:
+            if name in self.hung:
+                self.collector_facts[name] = None
+            else:
+                self.collector_facts[name] = self.run_collector(name)
+        return [name for name in names if name in self.hung]
+
+    def get_all(self):
+        allhw = {}
+        self.timed_out = self.run_collectors([name for name, method_name
+                                              in self.COLLECTORS])
+        for name, method_name in self.COLLECTORS:
+            self.collector_stamps[name] = self.collector_inputs(name)
+            allhw.update(self.collector_facts[name] or {})
+        return allhw
+
+
 class TestFacts(fixture.SubManFixture):
     def setUp(self):
         super(TestFacts, self).setUp()
@@ -288,8 +326,7 @@ class TestFacts(fixture.SubManFixture):
         #self.f.get_facts = 'asdfadfasdfadf'
         self.f.write_cache()
 
-        new_facts_buf = open(fact_cache).read()
-        new_facts = json.loads(new_facts_buf)
+        new_facts = self.f._read_cache()
         self.assertEquals(new_facts['newstuff'], 'newstuff_is_true')
 
     @patch('subscription_manager.facts.Facts._load_custom_facts',
@@ -300,3 +337,130 @@ class TestFacts(fixture.SubManFixture):
         self.assertTrue("system.certificate_version" in self.f.get_facts())
         self.assertEquals(facts.CERT_VERSION,
                 self.f.get_facts()['system.certificate_version'])
+
+
+@patch('subscription_manager.facts.Facts._load_custom_facts', return_value={})
+class TestFactSources(fixture.SubManFixture):
+    def setUp(self):
+        super(TestFactSources, self).setUp()
+        StubHardware.stamps = {'cpu': 'boot-1'}
+        StubHardware.found = {'cpu': {'cpu.cpu(s)': 8, 'cpu.cpu_mhz': '2420'},
+                              'network': {'network.hostname': 'host1'}}
+        StubHardware.ran = []
+        StubHardware.hung = []
+        self.hw_patcher = patch('subscription_manager.hwprobe.Hardware', StubHardware)
+        self.hw_patcher.start()
+
+        self._new_facts().write_cache()
+        StubHardware.ran = []
+
+    def tearDown(self):
+        self.hw_patcher.stop()
+        super(TestFactSources, self).tearDown()
+
+    def _new_facts(self):
+        f = facts.Facts(ent_dir=StubEntitlementDirectory([]),
+                        prod_dir=StubProductDirectory([]))
+        f.CACHE_FILE = "/nonexistent/facts.json"
+        return f
+
+    def test_unchanged_sources_not_run(self, mock_load_cf):
+        self.assertFalse(self._new_facts().has_changed())
+        # only the source without an input stamp had to run
+        self.assertEquals(['network'], StubHardware.ran)
+
+    def test_graylisted_change_ignored(self, mock_load_cf):
+        StubHardware.stamps = {}
+        StubHardware.found['cpu']['cpu.cpu_mhz'] = '1200'
+        self.assertFalse(self._new_facts().has_changed())
+
+    def test_changed_source(self, mock_load_cf):
+        StubHardware.found['network']['network.hostname'] = 'host2'
+        f = self._new_facts()
+        self.assertTrue(f.has_changed())
+        self.assertEquals('host2', f.facts['network.hostname'])
+
+    def test_changed_input_stamp(self, mock_load_cf):
+        StubHardware.stamps = {'cpu': 'boot-2'}
+        # same facts after all, found by the full comparison
+        self.assertFalse(self._new_facts().has_changed())
+        self.assertTrue('cpu' in StubHardware.ran)
+
+    def test_changed_custom_facts(self, mock_load_cf):
+        mock_load_cf.return_value = {'custom.fact': 'new'}
+        self.assertTrue(self._new_facts().has_changed())
+
+    def test_no_source_state(self, mock_load_cf):
+        facts.Facts._get_store().delete(facts.Facts.SOURCE_STATE)
+        self.assertFalse(self._new_facts().has_changed())
+        self.assertTrue('cpu' in StubHardware.ran)
+
+    def test_timed_out_collector(self, mock_load_cf):
+        StubHardware.hung = ['network']
+        f = self._new_facts()
+        uep = Mock()
+        self.assertEquals(0, f.update_check(uep, 'SOMEUUID'))
+        self.assertFalse(uep.updateConsumer.called)
+        # the cached facts stand in for those that timed out
+        self.assertEquals('host1', f.get_facts()['network.hostname'])
+        self.assertEquals(8, f.get_facts()['cpu.cpu(s)'])
+
+    def test_timed_out_collector_only_restored(self, mock_load_cf):
+        StubHardware.hung = ['cpu']
+        StubHardware.found['network'] = {}
+        hw_facts = self._new_facts().get_facts()
+        self.assertEquals(8, hw_facts['cpu.cpu(s)'])
+        # the network collector finished, its cached facts are stale
+        self.assertFalse('network.hostname' in hw_facts)
+
+    def test_fact_plugins(self, mock_load_cf):
+        f = self._new_facts()
+        f.plugin_manager.has_hooks.return_value = True
+        self.assertFalse(f.has_changed())
+        self.assertTrue('cpu' in StubHardware.ran)
+        f.plugin_manager.has_hooks.assert_called_with('post_facts_collection')
+
+    def test_unstamped_virt_uuid(self, mock_load_cf):
+        f = self._new_facts()
+        state = json.loads(f._get_store().get(f.SOURCE_STATE))
+        state['virt_uuid'] = [None, f._facts_digest({'virt.uuid': 'some-uuid'})]
+        f._get_store().put(f.SOURCE_STATE, json.dumps(state))
+
+        # no collector to run for it, the full facts are compared
+        self.assertFalse(f._sources_unchanged())
+        self.assertEquals([], StubHardware.ran)
+
+    def test_source_check_fails(self, mock_load_cf):
+        f = self._new_facts()
+        with patch.object(StubHardware, 'run_collectors', side_effect=OSError):
+            self.assertFalse(f._sources_unchanged())
+
+
+class TestFactCollectorCache(fixture.SubManFixture):
+    def setUp(self):
+        super(TestFactCollectorCache, self).setUp()
+        self.cache = facts.FactCollectorCache(self.cache_store)
+        self.cache.put('cpu', 'boot-1', {'cpu.cpu(s)': 8})
+        self.cache.write()
+
+    def test_cached(self):
+        cache = facts.FactCollectorCache(self.cache_store)
+        self.assertEquals({'cpu.cpu(s)': 8}, cache.get('cpu', 'boot-1'))
+
+    def test_other_stamp(self):
+        cache = facts.FactCollectorCache(self.cache_store)
+        self.assertEquals(None, cache.get('cpu', 'boot-2'))
+
+    @patch('subscription_manager.facts.cfg')
+    def test_expired(self, mock_cfg):
+        # cpu_facts_cache_ttl = 10 in rhsm.conf
+        mock_cfg.has_option.return_value = True
+        mock_cfg.get_int.return_value = 10
+        cache = facts.FactCollectorCache(self.cache_store)
+        cache._get_entries()['cpu'][1] -= 20
+        self.assertEquals(None, cache.get('cpu', 'boot-1'))
+        mock_cfg.get_int.assert_called_with('rhsm', 'cpu_facts_cache_ttl')
+
+    def test_collectors_without_ttl_not_cached(self):
+        self.cache.put('network', 'stamp', {'network.hostname': 'host1'})
+        self.assertEquals(None, self.cache.get('network', 'stamp'))
@@ -12,15 +12,21 @@
 # granted to use or replicate Red Hat trademarks that are incorporated
 # in this software or its documentation.
 
+import os
+import shutil
+import tempfile
 import unittest
 
 
 import cStringIO
+import logging
+import threading
 
 from mock import patch
 from mock import Mock
 
 import fixture
+from cputree import cpu_mask, write_cpu_tree
 from subscription_manager import hwprobe
 
 PROC_BONDING_RR = """Ethernet Channel Bonding Driver: v3.6.0 (September 26, 2009)
@@ -143,6 +149,11 @@ class TestGatherEntries(unittest.TestCase):
         ent_list = hwprobe.gather_entries(ent)
         self.assertEquals(2, len(ent_list))
 
+    def test_count_entries(self):
+        for ent in ["1", "1,2,3,4", "1-2", "1-4,9-12", "0,2", "0-4095,8192"]:
+            self.assertEquals(len(hwprobe.gather_entries(ent)),
+                              hwprobe.count_entries(ent))
+
 
 class GenericPlatformSpecificInfoProviderTests(fixture.SubManFixture):
     def test(self):
@@ -480,6 +491,42 @@ class HardwareProbeTests(fixture.SubManFixture):
         self.assertEquals(net_int['net.interface.lo.ipv6_address.global'], '::1')
         self.assertFalse('net.interface.lo.mac_address' in net_int)
 
+    @patch("ethtool.get_devices")
+    @patch("ethtool.get_interfaces_info")
+    def test_network_interfaces_excluded(self, MockGetInterfacesInfo, MockGetDevices):
+        reload(hwprobe)
+        hw = hwprobe.Hardware(exclude_interfaces=['veth*', 'tap?'])
+        MockGetDevices.return_value = ['eth0', 'veth1a2b', 'tap0', 'tap10']
+        MockGetInterfacesInfo.return_value = []
+
+        hw.get_network_interfaces()
+        # excluded devices are not queried at all
+        MockGetInterfacesInfo.assert_called_once_with(['eth0', 'tap10'])
+
+    @patch("os.readlink")
+    @patch("__builtin__.open")
+    @patch("ethtool.get_devices")
+    @patch("ethtool.get_interfaces_info")
+    def test_network_interfaces_bonding_read_once(self, MockGetInterfacesInfo,
+                                                  MockGetDevices, MockOpen, MockReadlink):
+        reload(hwprobe)
+        hw = hwprobe.Hardware()
+        MockGetDevices.return_value = ['eth0', 'eth1']
+        infos = []
+        for device in ['eth0', 'eth1']:
+            mock_info = Mock(mac_address="52:54:00:07:03:BA", device=device)
+            mock_info.get_ipv6_addresses.return_value = []
+            mock_info.get_ipv4_addresses.return_value = []
+            infos.append(mock_info)
+        MockGetInterfacesInfo.return_value = infos
+        MockReadlink.return_value = '../../devices/virtual/net/bond0'
+        MockOpen.return_value = cStringIO.StringIO(PROC_BONDING_RR)
+
+        net_int = hw.get_network_interfaces()
+        self.assertEquals(1, MockOpen.call_count)
+        self.assertEquals("52:54:00:07:03:BA", net_int['net.interface.eth0.permanent_mac_address'])
+        self.assertEquals("52:54:00:66:20:F7", net_int['net.interface.eth1.permanent_mac_address'])
+
     @patch("__builtin__.open")
     def test_get_slave_hwaddr_rr(self, MockOpen):
         reload(hwprobe)
@@ -740,3 +787,376 @@ class HardwareProbeTests(fixture.SubManFixture):
                                 'cpu.topology_source':
                                     'kernel /sys cpu sibling lists'},
                                hw.get_cpu_info())
+
+
+class HardwareCollectorsTests(fixture.SubManFixture):
+
+    def setUp(self):
+        super(HardwareCollectorsTests, self).setUp()
+        self.hw = hwprobe.Hardware()
+        self.release = threading.Event()
+        for name, method_name in self.hw.COLLECTORS:
+            setattr(self.hw, method_name, self._collector(name))
+
+    def tearDown(self):
+        # let hung collectors finish
+        self.release.set()
+        super(HardwareCollectorsTests, self).tearDown()
+
+    def _collector(self, name):
+        def collect():
+            found = {'%s.fact' % name: name}
+            if name == 'platform':
+                found['platform.saw_cpu'] = 'cpu.fact' in self.hw.allhw
+            self.hw.allhw.update(found)
+            return found
+        return collect
+
+    def _hang(self):
+        self.release.wait(10)
+        self.hw.allhw['network.hung'] = True
+        return {'network.hung': True}
+
+    def test_all_collected(self):
+        facts = self.hw.get_all()
+        self.assertEquals([], self.hw.timed_out)
+        for name, method_name in self.hw.COLLECTORS:
+            self.assertEquals(name, facts['%s.fact' % name])
+        self.assertTrue(facts['platform.saw_cpu'])
+
+    @patch('subscription_manager.hwprobe.COLLECTOR_TIMEOUTS', {'network': 0.1})
+    @patch('subscription_manager.hwprobe.COLLECTOR_THREADS', 1)
+    def test_timed_out_collector(self):
+        self.hw.get_network_info = self._hang
+        facts = self.hw.get_all()
+
+        self.assertEquals(['network'], self.hw.timed_out)
+        self.assertEquals(None, self.hw.collector_facts['network'])
+        self.assertFalse('network.hung' in facts)
+        # the others still ran, in the slot the hung one had
+        self.assertEquals('platform', facts['platform.fact'])
+        self.assertEquals('virt', facts['virt.fact'])
+
+    def test_run_some_collectors(self):
+        self.assertEquals([], self.hw.run_collectors(['platform', 'cpu']))
+        self.assertEquals(['cpu', 'platform'], sorted(self.hw.collector_facts))
+        self.assertTrue(self.hw.allhw['platform.saw_cpu'])
+
+    def test_cached_collectors_not_run(self):
+        cache = Mock()
+        cache.get.side_effect = lambda name, stamp: \
+            name == 'cpu' and {'cpu.fact': 'cached'} or None
+        self.hw.collector_cache = cache
+        self.hw.collector_inputs = lambda name: 'stamp'
+        self.hw.get_cpu_info = Mock()
+
+        facts = self.hw.get_all()
+        self.assertEquals('cached', facts['cpu.fact'])
+        self.assertFalse(self.hw.get_cpu_info.called)
+        # everything that ran is cached for next time
+        cache.put.assert_any_call('mem', 'stamp', {'mem.fact': 'mem'})
+        self.assertFalse(('cpu', 'stamp', {'cpu.fact': 'cached'}) in
+                         [c[0] for c in cache.put.call_args_list])
+
+    def test_collectors_log_from_caller(self):
+        emitted = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                emitted.append((record.getMessage(), threading.currentThread()))
+
+        def collect():
+            hwprobe.log.warn("from the cpu collector")
+            return {}
+        self.hw.get_cpu_info = collect
+        handler = Handler()
+        hwprobe.log.addHandler(handler)
+        try:
+            self.hw.run_collectors(['cpu'])
+        finally:
+            hwprobe.log.removeHandler(handler)
+        self.assertEquals([("from the cpu collector", threading.currentThread())],
+                          emitted)
+
+    def test_failed_virt_what_not_cached(self):
+        self.hw.collector_cache = Mock()
+        self.hw.collector_cache.get.return_value = None
+        self.hw.collector_inputs = lambda name: 'stamp'
+        del self.hw.get_virt_info
+        self.hw._get_output = Mock(side_effect=OSError('no virt-what'))
+
+        facts = self.hw.get_all()
+        self.assertEquals('Unknown', facts['virt.is_guest'])
+        self.assertEquals(set(['virt']), self.hw.degraded)
+        # detected again next time instead
+        self.assertEquals(None, self.hw.collector_stamps['virt'])
+        self.assertFalse('virt' in [c[0][0] for c in
+                                    self.hw.collector_cache.put.call_args_list])
+        self.hw.collector_cache.put.assert_any_call('mem', 'stamp', {'mem.fact': 'mem'})
+
+
+SYNTHETIC_CPUINFO = """processor\t: 0
+vendor_id\t: GenuineIntel
+cpu family\t: 6
+model\t\t: 23
+model name\t: Intel(R) Xeon(R) CPU E5420 @ 2.50GHz
+stepping\t: 10
+cpu MHz\t\t: 1995.095
+flags\t\t: fpu vme lm vmx
+bogomips\t: 4987.44
+
+processor\t: 1
+vendor_id\t: GenuineIntel
+model name\t: not the first processor
+"""
+
+# /proc/cpuinfo of the 7 online cpus of the LsCpuInfoTests tree
+FULL_CPUINFO = "\n".join(["""processor\t: %s
+vendor_id\t: GenuineIntel
+cpu family\t: 6
+model\t\t: 23
+model name\t: Intel(R) Xeon(R) CPU E5420 @ 2.50GHz
+stepping\t: 10
+physical id\t: %s
+cpu MHz\t\t: 1995.095
+flags\t\t: fpu vme lm vmx
+bogomips\t: 4987.44
+""" % (cpu, cpu / 4) for cpu in range(7)])
+
+
+# LC_ALL=C lscpu -s of util-linux 2.38.1 on the LsCpuInfoTests tree, with
+# FULL_CPUINFO for its cpuinfo
+LSCPU_OUTPUT = """Architecture:         x86_64
+CPU op-mode(s):       32-bit, 64-bit
+Byte Order:           Little Endian
+CPU(s):               8
+On-line CPU(s) list:  0-6
+Off-line CPU(s) list: 7
+Vendor ID:            GenuineIntel
+Model name:           Intel(R) Xeon(R) CPU E5420 @ 2.50GHz
+CPU family:           6
+Model:                23
+Thread(s) per core:   1
+Core(s) per socket:   4
+Socket(s):            2
+Stepping:             10
+CPU(s) scaling MHz:   80%
+CPU max MHz:          2500.0000
+CPU min MHz:          0.0000
+BogoMIPS:             4987.44
+Flags:                fpu vme lm vmx
+Virtualization:       VT-x
+L1d cache:            32 KiB (1 instance)
+L1i cache:            32 KiB (1 instance)
+L2 cache:             6 MiB (1 instance)
+NUMA node(s):         1
+NUMA node0 CPU(s):    0-6
+"""
+
+# LC_ALL=C lscpu -s of util-linux 2.38.1 on write_cpu_tree(prefix, 16,
+# threads_per_core=2, cores_per_socket=4)
+LSCPU_OUTPUT_16_CPUS = """Architecture:        x86_64
+CPU op-mode(s):      32-bit, 64-bit
+Byte Order:          Little Endian
+CPU(s):              16
+On-line CPU(s) list: 0-15
+Vendor ID:           GenuineIntel
+Model name:          Intel(R) Xeon(R) Gold 6130 CPU @ 2.10GHz
+CPU family:          6
+Model:               85
+Thread(s) per core:  2
+Core(s) per socket:  4
+Socket(s):           2
+Stepping:            4
+BogoMIPS:            4200.00
+Flags:               fpu vme lm
+"""
+
+# lscpu facts newer util-linux reports differently than the lscpu of
+# RHEL, it sums up the caches of all cpus and reports no minimum
+# frequency for a tree given with -s
+LSCPU_CHANGED_FACTS = ['lscpu.l1d_cache', 'lscpu.l1i_cache', 'lscpu.l2_cache',
+                       'lscpu.cpu_min_mhz', 'lscpu.cpu(s)_scaling_mhz']
+
+
+class LsCpuOutputTestMixin(object):
+
+    def assert_lscpu_output(self, lscpu_output, facts):
+        """ Check facts has every fact of the recorded lscpu output. """
+        for key, value in hwprobe.parse_lscpu_output(lscpu_output).items():
+            if key not in LSCPU_CHANGED_FACTS:
+                self.assertEquals(value, facts.get(key), key)
+
+
+class LsCpuInfoTests(fixture.SubManFixture, LsCpuOutputTestMixin):
+    """
+    get_ls_cpu_info() on a sysfs tree of 2 sockets of 4 cores, with the
+    last cpu offline, and the facts the lscpu command reports for it.
+    """
+
+    def setUp(self):
+        super(LsCpuInfoTests, self).setUp()
+        self.prefix = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self._write('arch', 'x86_64')
+        self._write('proc/cpuinfo', SYNTHETIC_CPUINFO)
+        self._write('sys/devices/system/cpu/online', '0-6')
+        self._write('sys/devices/system/cpu/present', '0-7')
+        self._write('sys/devices/system/cpu/possible', '0-7')
+        for cpu in range(8):
+            topology = 'sys/devices/system/cpu/cpu%s/topology/' % cpu
+            socket = range(cpu - cpu % 4, cpu - cpu % 4 + 4)
+            self._write(topology + 'thread_siblings_list', str(cpu))
+            self._write(topology + 'core_siblings_list', hwprobe.format_entries(socket))
+            # the masks lscpu reads
+            self._write(topology + 'thread_siblings', cpu_mask([cpu], 8))
+            self._write(topology + 'core_siblings', cpu_mask(socket, 8))
+        self._write('sys/devices/system/cpu/cpu0/cpufreq/cpuinfo_max_freq', '2500000')
+        self._write('sys/devices/system/cpu/cpu0/cpufreq/cpuinfo_min_freq', '1200000')
+        for index, (level, cache_type, size) in enumerate([('1', 'Data', '32K'),
+                                                           ('1', 'Instruction', '32K'),
+                                                           ('2', 'Unified', '6144K')]):
+            cache = 'sys/devices/system/cpu/cpu0/cache/index%s/' % index
+            self._write(cache + 'level', level)
+            self._write(cache + 'type', cache_type)
+            self._write(cache + 'size', size)
+        self._write('sys/devices/system/node/node0/cpulist', '0-6')
+        self._write('sys/devices/system/node/node0/cpumap', cpu_mask(range(7), 8))
+
+    def tearDown(self):
+        shutil.rmtree(self.prefix)
+        super(LsCpuInfoTests, self).tearDown()
+
+    def _write(self, path, content):
+        path = os.path.join(self.prefix, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'w')
+        f.write(content + '\n')
+        f.close()
+
+    def test_ls_cpu_info(self):
+        hw = hwprobe.Hardware(prefix=self.prefix, testing=True)
+        hw.run_lscpu = Mock()
+        self.assert_equal_dict({'lscpu.architecture': 'x86_64',
+                                'lscpu.cpu_op-mode(s)': '32-bit, 64-bit',
+                                'lscpu.byte_order': 'Little Endian',
+                                'lscpu.cpu(s)': '8',
+                                'lscpu.on-line_cpu(s)_list': '0-6',
+                                'lscpu.off-line_cpu(s)_list': '7',
+                                'lscpu.thread(s)_per_core': '1',
+                                'lscpu.core(s)_per_socket': '4',
+                                'lscpu.socket(s)': '2',
+                                'lscpu.cpu_max_mhz': '2500.0000',
+                                'lscpu.cpu_min_mhz': '1200.0000',
+                                'lscpu.numa_node(s)': '1',
+                                'lscpu.numa_node0_cpu(s)': '0-6',
+                                'lscpu.vendor_id': 'GenuineIntel',
+                                'lscpu.cpu_family': '6',
+                                'lscpu.model': '23',
+                                'lscpu.model_name': 'Intel(R) Xeon(R) CPU E5420 @ 2.50GHz',
+                                'lscpu.stepping': '10',
+                                'lscpu.cpu_mhz': '1995.095',
+                                'lscpu.bogomips': '4987.44',
+                                'lscpu.flags': 'fpu vme lm vmx',
+                                'lscpu.virtualization': 'VT-x',
+                                'lscpu.l1d_cache': '32K',
+                                'lscpu.l1i_cache': '32K',
+                                'lscpu.l2_cache': '6144K'},
+                               hw.get_ls_cpu_info())
+        # no need for the command on a x86 host
+        self.assertFalse(hw.run_lscpu.called)
+
+    def test_recorded_lscpu_output(self):
+        self._write('proc/cpuinfo', FULL_CPUINFO)
+        hw = hwprobe.Hardware(prefix=self.prefix, testing=True)
+        self.assert_lscpu_output(LSCPU_OUTPUT, hw.get_ls_cpu_info())
+
+    def test_guest_adds_lscpu_command_facts(self):
+        self._write('proc/cpuinfo', SYNTHETIC_CPUINFO.replace('lm vmx', 'lm hypervisor'))
+        hw = hwprobe.Hardware(prefix=self.prefix, testing=True)
+        hw.run_lscpu = Mock(return_value={'lscpu.hypervisor_vendor': 'KVM',
+                                          'lscpu.virtualization_type': 'full'})
+        facts = hw.get_ls_cpu_info()
+        self.assertEquals('KVM', facts['lscpu.hypervisor_vendor'])
+        self.assertEquals('full', facts['lscpu.virtualization_type'])
+        self.assertEquals('2', facts['lscpu.socket(s)'])
+
+    def test_s390x_adds_lscpu_command_facts(self):
+        hw = hwprobe.Hardware(prefix=self.prefix, testing=True)
+        hw.arch = 's390x'
+        hw.run_lscpu = Mock(return_value={'lscpu.dispatching_mode': 'horizontal'})
+        self.assertEquals('horizontal', hw.get_ls_cpu_info()['lscpu.dispatching_mode'])
+
+    def test_no_sys_cpu(self):
+        shutil.rmtree(os.path.join(self.prefix, 'sys'))
+        hw = hwprobe.Hardware(prefix=self.prefix, testing=True)
+        self.assertEquals({}, hw.get_ls_cpu_info())
+
+    def test_parse_lscpu_output(self):
+        self.assertEquals({'lscpu.cpu(s)': '8', 'lscpu.on-line_cpu(s)_list': '0-6'},
+                          hwprobe.parse_lscpu_output("CPU(s):  8\n"
+                                                     "On-line CPU(s) list: 0-6\n"
+                                                     "not a fact\n"))
+
+    def test_format_entries(self):
+        self.assertEquals('0-2,5,7-8', hwprobe.format_entries([8, 0, 1, 2, 5, 7]))
+        self.assertEquals('', hwprobe.format_entries([]))
+
+
+class LargeCpuInfoTests(fixture.SubManFixture, LsCpuOutputTestMixin):
+    """
+    cpu facts of a sysfs tree of 4096 cpus, 64 sockets of 32 cores with
+    2 threads each.
+    """
+
+    CPUS = 4096
+
+    def setUp(self):
+        super(LargeCpuInfoTests, self).setUp()
+        self.prefix = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        write_cpu_tree(self.prefix, self.CPUS, threads_per_core=2, cores_per_socket=32)
+
+    def tearDown(self):
+        shutil.rmtree(self.prefix)
+        super(LargeCpuInfoTests, self).tearDown()
+
+    def test_cpu_info(self):
+        hw = hwprobe.Hardware(prefix=self.prefix, testing=True)
+        hw.arch = 'x86_64'
+        cpu_info = hw.get_cpu_info()
+        self.assertEquals(4096, cpu_info['cpu.cpu(s)'])
+        self.assertEquals(64, cpu_info['cpu.cpu_socket(s)'])
+        self.assertEquals(32, cpu_info['cpu.core(s)_per_socket'])
+        self.assertEquals(2, cpu_info['cpu.thread(s)_per_core'])
+
+    def test_ls_cpu_info(self):
+        hw = hwprobe.Hardware(prefix=self.prefix, testing=True)
+        ls_cpu_info = hw.get_ls_cpu_info()
+        self.assertEquals('4096', ls_cpu_info['lscpu.cpu(s)'])
+        self.assertEquals('0-4095', ls_cpu_info['lscpu.on-line_cpu(s)_list'])
+        self.assertEquals('64', ls_cpu_info['lscpu.socket(s)'])
+        self.assertEquals('32', ls_cpu_info['lscpu.core(s)_per_socket'])
+        self.assertEquals('2', ls_cpu_info['lscpu.thread(s)_per_core'])
+
+    def test_recorded_lscpu_output(self):
+        prefix = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        try:
+            write_cpu_tree(prefix, 16, threads_per_core=2, cores_per_socket=4)
+            hw = hwprobe.Hardware(prefix=prefix, testing=True)
+            self.assert_lscpu_output(LSCPU_OUTPUT_16_CPUS, hw.get_ls_cpu_info())
+        finally:
+            shutil.rmtree(prefix)
+
+    def test_files_read_once(self):
+        hw = hwprobe.Hardware(prefix=self.prefix, testing=True)
+        hw.arch = 'x86_64'
+        real_listdir = os.listdir
+        with patch('os.listdir', side_effect=real_listdir) as mock_listdir:
+            with patch('__builtin__.open', side_effect=open) as mock_open:
+                hw.get_cpu_info()
+                hw.get_ls_cpu_info()
+        sys_cpu_path = os.path.join(self.prefix, 'sys/devices/system/cpu/')
+        self.assertEquals(1, [call[0][0] for call in mock_listdir.call_args_list].count(sys_cpu_path))
+        # nothing is opened per cpu, only the sibling lists of the first
+        # and the core siblings of one cpu in each of the 64 sockets
+        self.assertTrue(mock_open.call_count < 100)
@@ -164,6 +164,26 @@ class TestEntitlementSource(fixture.SubManFixture):
 
         self.assertTrue(isinstance(es[0], model.Entitlement))
 
+    def test_content_index_built_once(self):
+        esb = EntitlementSourceBuilder()
+        es = esb.ent_source()
+
+        es.find_content(content_type="yum")
+        index = es._content_index
+        es.find_content(content_type="ostree")
+        self.assertTrue(index is es._content_index)
+
+    def test_content_index_follows_entitlements(self):
+        esb = EntitlementSourceBuilder()
+        es = esb.ent_source()
+        self.assertEquals(4, len(es.find_content(content_type="yum")))
+
+        es._entitlements.append(model.Entitlement(contents=esb.contents_list('content3')))
+        self.assertEquals(6, len(es.find_content(content_type="yum")))
+
+        es._entitlements = []
+        self.assertEquals([], es.find_content(content_type="yum"))
+
 
 class TestFindContent(fixture.SubManFixture):
     def test(self):
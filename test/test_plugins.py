@@ -729,6 +729,11 @@ class TestPluginManagerRunIter(TestPluginManagerRun):
         self.manager.add_plugins_from_module(plugin_module)
         # add
 
+    def test_has_hooks(self):
+        self.assertTrue(self.manager.has_hooks("post_product_id_install"))
+        self.assertFalse(self.manager.has_hooks("pre_product_id_install"))
+        self.assertFalse(self.manager.has_hooks("this_is_a_slot_that_doesnt_exist"))
+
     def test_dummy_runiter(self):
         for runner in self.manager.runiter("post_product_id_install", product_list=[]):
             runner.run()